@@ -25,9 +25,20 @@ $(${_find} -name \*.sh) \
 for script in ${scripts} ; do
     base=$(basename ${script%.*})
     target=${target_dir}/${base}
+    mode=755
+    # Python files without #! are modules imported by the scripts next
+    # to them, which need them installed under their own name
+    case ${script} in
+	*.py)
+	    if test "$(head -c 2 ${script})" != "#!" ; then
+		target=${target_dir}/$(basename ${script})
+		mode=644
+	    fi
+	    ;;
+    esac
     if test ! -e ${target} -o ${script} -nt ${target} ; then
 	echo "Installing ${script} to ${target}"
-	install -m 755 ${script} ${target}
+	install -m ${mode} ${script} ${target}
     fi
 done
 
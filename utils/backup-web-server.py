@@ -17,19 +17,96 @@ password=password
 
 [scp]
 dest=user@host:/dest/path
+
+With --stream, the tarball is not written locally but piped through
+ssh to the destination as it is made. It is written there under a
+temporary name, checked against a SHA-256 checksum computed as it was
+sent, and only then renamed, with the checksum saved alongside it in
+the format of sha256sum. On failure the temporary file is removed.
+
+The tarball is compressed with --compressor:
+  gzip - pigz if installed, or in this process with zlib (the default)
+  zlib - in this process, in blocks compressed by a pool of threads
+  zstd - zstd using all the threads, or zlib if zstd is not installed
+  none - not at all
+
+Each database is dumped with mysqldump --single-transaction straight
+into the tarball, --dumpJobs at a time, without a copy on local disk.
+As tar needs the size of a file before its contents, each dump is
+stored as members of up to 64MB, mysql/<database>.sql.000000 and on;
+to restore one:
+
+  tar xf backup.tar.gz mysql/database.sql.\*
+  cat mysql/database.sql.* | mysql
+
+If the configuration has an [incremental] section, most backups are
+incremental, holding only what has changed since the one before, by
+way of a GNU tar --listed-incremental snapshot file:
+
+[incremental]
+# Snapshot file, kept between runs
+snapshotFile=/var/lib/backup-web-server/snapshot
+# Make a full backup if the last was more than this many days ago
+# (default 7), or with --full
+fullEvery=7
+
+The tarballs are named backup-<host>-<date>-<time>-full or -incr.
+--restore fetches the latest full backup and the incremental ones after
+it from the destination and extracts them in order into --restoreTo,
+tar removing files that were deleted in between. The database dumps
+are taken from the last of them.
 """
 from __future__ import with_statement
 import atexit
 import ConfigParser
+import hashlib
+import multiprocessing
 import optparse
 import os
 import os.path
+import pipes
+import re
+import shutil
 import socket
 import subprocess
 import sys
+from tarfile import TarInfo
 import tempfile
+import threading
 import time
 
+from parallel_gzip import ParallelGzip, compressCmd
+
+# Arguments for ssh and scp
+SSH_OPTIONS = [
+    # Use blowfish for speed
+    "-c", "blowfish",
+    # Batch mode, no passwords or other prompts
+    "-o", "BatchMode=yes",
+    ]
+
+# Size of reads from tar when streaming
+BLOCK_SIZE = 1024 * 1024
+
+# Suffix of a streamed tarball until it is complete and checked
+PARTIAL_SUFFIX = ".part"
+
+MYSQL = "/usr/bin/mysql"
+MYSQLDUMP = "/usr/bin/mysqldump"
+
+# Databases mysqldump --all-databases leaves out
+SKIP_DATABASES = ["information_schema", "performance_schema"]
+
+# Largest tarball member of a database dump, which is held in memory
+DUMP_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Commands to decompress a tarball, by suffix
+DECOMPRESS_CMDS = {
+    ".gz" : ["gzip", "-dc"],
+    ".zst" : ["zstd", "-dc"],
+    "" : ["cat"],
+}
+
 ######################################################################
 #
 # Utility functions
@@ -43,6 +120,405 @@ def runCmd(cmd):
                           # Try to keep stderr and stdout in sync
                           stderr=subprocess.STDOUT)
 
+class StreamException(Exception):
+    pass
+
+class ArchiveException(Exception):
+    pass
+
+class ArchiveWriter:
+    """Write the tarball, uncompressed, to a file object or a pipe in a
+    thread, looking enough like a tar process to go in its place: the
+    database dumps as they are made, then pathsToBackup by tar.
+
+    The dumps are written as members of at most DUMP_CHUNK_SIZE, with
+    no end of archive marker after them, so they and what tar writes
+    make one archive. The database name, size in bytes and seconds
+    taken of each dump are in dumps when done."""
+
+    def __init__(self, output, pathsToBackup, databases=[],
+                 mysqlOptions=[], dumpJobs=1, tarOptions=[]):
+        self.stdout = None
+        if output == subprocess.PIPE:
+            readFD, writeFD = os.pipe()
+            self.stdout = os.fdopen(readFD, "rb")
+            output = os.fdopen(writeFD, "wb")
+        self._output = output
+        self._pathsToBackup = pathsToBackup
+        self._databases = databases
+        self._mysqlOptions = mysqlOptions
+        self._dumpJobs = dumpJobs
+        self._tarOptions = tarOptions
+        # Held to change the lists below, never while blocked
+        self._lock = threading.Lock()
+        # Held to write a member, so members are not interleaved. A
+        # write can block on a full pipe, so nothing else waits on it
+        self._writeLock = threading.Lock()
+        self._processes = []
+        self._killed = False
+        self.dumps = []
+        self.error = None
+        self.returncode = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def _start(self, cmd, stdout=subprocess.PIPE):
+        with self._lock:
+            if self._killed:
+                raise ArchiveException("Stopped")
+            # Pipes to other processes must not be held open
+            process = subprocess.Popen(cmd, stdout=stdout, close_fds=True)
+            self._processes.append(process)
+        if self._killed:
+            # kill() may have missed it
+            process.kill()
+        return process
+
+    def _writeMember(self, name, data):
+        info = TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0600
+        with self._writeLock:
+            self._output.write(info.tobuf())
+            self._output.write(data)
+            # Members are padded to 512 byte blocks
+            self._output.write("\0" * (-len(data) % 512))
+
+    def _dump(self, database):
+        started = time.time()
+        size = 0
+        part = 0
+        dump = self._start([MYSQLDUMP] + self._mysqlOptions +
+                           ["--single-transaction", "--databases", database])
+        while True:
+            data = dump.stdout.read(DUMP_CHUNK_SIZE)
+            if data or part == 0:
+                self._writeMember("mysql/%s.sql.%06d" % (database, part),
+                                  data)
+            size += len(data)
+            part += 1
+            if len(data) < DUMP_CHUNK_SIZE:
+                break
+        dump.stdout.close()
+        status = dump.wait()
+        if status != 0:
+            raise ArchiveException("mysqldump of %s failed (returned %d)" %
+                                   (database, status))
+        with self._lock:
+            self.dumps.append((database, size, time.time() - started))
+
+    def _dumpAll(self):
+        pending = list(self._databases)
+        errors = []
+        def worker():
+            while True:
+                with self._lock:
+                    if errors or not pending:
+                        return
+                    database = pending.pop(0)
+                try:
+                    self._dump(database)
+                except Exception, e:
+                    with self._lock:
+                        errors.append(e)
+                    self._stopProcesses()
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(self._dumpJobs, len(pending)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _run(self):
+        try:
+            self._dumpAll()
+            self._output.flush()
+            tar = self._start(["tar", "cfP", "-"] + self._tarOptions +
+                              self._pathsToBackup, stdout=self._output)
+            status = tar.wait()
+            if status != 0:
+                raise ArchiveException("tar failed (returned %d)" % status)
+            self.returncode = 0
+        except (ArchiveException, IOError, OSError), e:
+            self.error = str(e)
+            self.returncode = 1
+        finally:
+            try:
+                self._output.close()
+            except IOError:
+                # Whatever read the output has gone
+                pass
+
+    def _stopProcesses(self):
+        for process in list(self._processes):
+            if process.poll() is None:
+                process.kill()
+
+    def poll(self):
+        if self._thread.is_alive():
+            return None
+        return self.returncode
+
+    def wait(self):
+        self._thread.join()
+        return self.returncode
+
+    def kill(self):
+        # Takes no lock, as the thread may hold one while blocked
+        # writing to the pipeline
+        self._killed = True
+        self._stopProcesses()
+        if self.stdout is not None:
+            # Fail any write blocked on the pipe
+            self.stdout.close()
+
+def listDatabases(mysqlOptions):
+    """Return the names of the databases to back up. Raises an
+    ArchiveException if mysql fails."""
+    pipe = subprocess.Popen([MYSQL] + mysqlOptions +
+                            ["--batch", "--skip-column-names",
+                             "--execute=SHOW DATABASES"],
+                            stdout=subprocess.PIPE)
+    output = pipe.communicate()[0]
+    if pipe.returncode != 0:
+        raise ArchiveException("mysql failed (returned %d)" %
+                               pipe.returncode)
+    return [name for name in output.splitlines()
+            if name not in SKIP_DATABASES]
+
+def startArchive(output, compressor, jobs, pathsToBackup, databases=[],
+                 mysqlOptions=[], dumpJobs=1, tarOptions=[]):
+    """Start writing the tarball of pathsToBackup and databases,
+    compressed with compressor using jobs threads, to the file object
+    output or subprocess.PIPE. tarOptions are added to those of tar.
+
+    Returns a list of (name, process) of the ArchiveWriter and the
+    compressor, if any, the last of which has the output if it is a
+    pipe."""
+    suffix, command = compressCmd(compressor, jobs)
+    sys.stdout.flush()
+    if command == []:
+        return [("archive", ArchiveWriter(output, pathsToBackup, databases,
+                                          mysqlOptions, dumpJobs,
+                                          tarOptions))]
+    if command is None:
+        compress = ParallelGzip(subprocess.PIPE, output, jobs)
+        name = "zlib"
+    else:
+        compress = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                    stdout=output, close_fds=True)
+        name = command[0]
+    # The writer closes the compressor's input when done
+    writer = ArchiveWriter(compress.stdin, pathsToBackup, databases,
+                           mysqlOptions, dumpJobs, tarOptions)
+    return [("archive", writer), (name, compress)]
+
+def killPipeline(pipeline):
+    """Stop and wait for the processes of pipeline."""
+    # From the end, so earlier ones blocked writing to later ones fail
+    for name, process in reversed(pipeline):
+        if process.poll() is None:
+            process.kill()
+    for name, process in pipeline:
+        process.wait()
+
+def failedPipeline(pipeline):
+    """Wait for the processes of pipeline and return a description of
+    the first to fail, or None if all succeed."""
+    failure = None
+    for name, process in pipeline:
+        status = process.wait()
+        if status != 0 and failure is None:
+            failure = getattr(process, "error", None) or \
+                "%s failed (returned %d)" % (name, status)
+    return failure
+
+def sshCmd(host, command):
+    """Return arguments to run shell command on host via ssh."""
+    return ["ssh"] + SSH_OPTIONS + [host, command]
+
+def streamToRemote(source, host, path):
+    """Copy file object source to path on host via ssh.
+
+    The file is written to path with PARTIAL_SUFFIX appended, which is
+    removed if the copy fails. Returns the SHA-256 digest of what was
+    sent, as hex, and its size, once the file on host has been found
+    to have the same digest. The file is left under its temporary
+    name."""
+    partial = pipes.quote(path + PARTIAL_SUFFIX)
+    # If the connection drops, the remote shell gets SIGHUP
+    command = ("trap 'rm -f %s; exit 1' HUP INT TERM PIPE;"
+               " cat > %s && (sha256sum || shasum -a 256) < %s" %
+               (partial, partial, partial))
+    sys.stdout.flush()
+    # Other pipes must not be held open by ssh, or they never end
+    pipe = subprocess.Popen(sshCmd(host, command), close_fds=True,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        for block in iter(lambda: source.read(BLOCK_SIZE), ""):
+            digest.update(block)
+            size += len(block)
+            try:
+                pipe.stdin.write(block)
+            except IOError:
+                # ssh has gone, the status below says why
+                break
+        pipe.stdin.close()
+        output = pipe.stdout.read()
+        if pipe.wait() != 0:
+            raise StreamException("ssh to %s failed (returned %d)" %
+                                  (host, pipe.returncode))
+        if output.split()[:1] != [digest.hexdigest()]:
+            raise StreamException("Checksum of %s on %s does not match" %
+                                  (path, host))
+    except:
+        if pipe.poll() is None:
+            pipe.kill()
+            pipe.wait()
+        removeRemote(host, path + PARTIAL_SUFFIX)
+        raise
+    return digest.hexdigest(), size
+
+def removeRemote(host, path):
+    """Try to remove path on host. Errors are ignored, as this is
+    cleaning up after another."""
+    subprocess.call(sshCmd(host, "rm -f %s" % pipes.quote(path)))
+
+def streamBackup(pipeline, host, path):
+    """Copy the tarball made by pipeline, started by startArchive() with
+    its output to a pipe, straight to path on host via ssh.
+
+    Returns the hex SHA-256 digest and size of the tarball. Raises
+    StreamException if making or copying it fails, leaving no file at
+    path or its temporary name."""
+    output = pipeline[-1][1].stdout
+    try:
+        hexdigest, size = streamToRemote(output, host, path)
+    except:
+        killPipeline(pipeline)
+        raise
+    output.close()
+    failure = failedPipeline(pipeline)
+    if failure is not None:
+        removeRemote(host, path + PARTIAL_SUFFIX)
+        raise StreamException(failure)
+    name = os.path.basename(path)
+    command = "mv %s %s && echo %s > %s" % (
+        pipes.quote(path + PARTIAL_SUFFIX), pipes.quote(path),
+        pipes.quote("%s  %s" % (hexdigest, name)),
+        pipes.quote(path + ".sha256"))
+    if subprocess.call(sshCmd(host, command)) != 0:
+        removeRemote(host, path + PARTIAL_SUFFIX)
+        raise StreamException("Renaming %s on %s failed" % (path, host))
+    return hexdigest, size
+
+def splitDest(scpDest):
+    """Return the host and directory of scp destination scpDest, or None
+    if it is not of the form host:path."""
+    if ":" not in scpDest:
+        return None
+    return scpDest.split(":", 1)
+
+def listChain(host, destDir, backupHost, until=None):
+    """Return the names of the tarballs of backupHost in destDir on host
+    to restore in order: the last full backup, up to and including
+    until if given, and the incremental backups after it.
+
+    Tarballs named without -full or -incr are full backups made before
+    incremental backups were. Raises an ArchiveException if there is no
+    full backup."""
+    pipe = subprocess.Popen(sshCmd(host, "ls %s" % pipes.quote(destDir or ".")),
+                            stdout=subprocess.PIPE, close_fds=True)
+    output = pipe.communicate()[0]
+    if pipe.returncode != 0:
+        raise ArchiveException("Listing %s on %s failed (returned %d)" %
+                               (destDir, host, pipe.returncode))
+    pattern = re.compile(r"^backup-%s-(\d{6}(?:-\d{6})?)(-full|-incr)?\.tar"
+                         r"(?:\.gz|\.zst)?$" % re.escape(backupHost))
+    backups = []
+    for name in output.splitlines():
+        match = pattern.match(name)
+        if match:
+            backups.append((match.group(1), match.group(2) != "-incr", name))
+    backups.sort()
+    if until is not None:
+        names = [name for stamp, full, name in backups]
+        if until not in names:
+            raise ArchiveException("No backup %s on %s" % (until, host))
+        backups = backups[:names.index(until) + 1]
+    fulls = [index for index, (stamp, full, name) in enumerate(backups)
+             if full]
+    if not fulls:
+        raise ArchiveException("No full backup of %s in %s on %s" %
+                               (backupHost, destDir, host))
+    return [name for stamp, full, name in backups[fulls[-1]:]]
+
+def restoreArchive(host, path, restoreTo, excludeDumps=False):
+    """Extract the tarball at path on host into restoreTo, fetched via
+    ssh and decompressed as it is extracted. Files in directories of an
+    incremental backup which were deleted before it are removed.
+    Returns a description of what failed, or None."""
+    suffix = os.path.splitext(path)[1]
+    if suffix == ".tar":
+        suffix = ""
+    sys.stdout.flush()
+    fetch = subprocess.Popen(sshCmd(host, "cat %s" % pipes.quote(path)),
+                             stdout=subprocess.PIPE, close_fds=True)
+    decompress = subprocess.Popen(DECOMPRESS_CMDS[suffix],
+                                  stdin=fetch.stdout, stdout=subprocess.PIPE,
+                                  close_fds=True)
+    fetch.stdout.close()
+    tarCmd = ["tar", "xf", "-", "--listed-incremental=/dev/null",
+              "-C", restoreTo]
+    if excludeDumps:
+        tarCmd.extend(["--anchored", "--exclude=mysql"])
+    tar = subprocess.Popen(tarCmd, stdin=decompress.stdout, close_fds=True)
+    decompress.stdout.close()
+    return failedPipeline([("ssh", fetch), (DECOMPRESS_CMDS[suffix][0],
+                                            decompress), ("tar", tar)])
+
+def restore(scpDest, backupHost, restoreTo, until=None):
+    """Restore the backups of backupHost at scpDest into restoreTo.
+    Returns the exit status."""
+    dest = splitDest(scpDest)
+    if dest is None:
+        print "Destination %s is not of the form host:path" % scpDest
+        return 1
+    host, destDir = dest
+    try:
+        chain = listChain(host, destDir, backupHost, until)
+    except ArchiveException, e:
+        print "Restore failed: %s" % e
+        return 1
+    for number, name in enumerate(chain):
+        print "Restoring %s into %s..." % (name, restoreTo)
+        # Dumps are whole each time, so only the last is wanted
+        failure = restoreArchive(host,
+                                 destDir and os.path.join(destDir, name)
+                                 or name, restoreTo,
+                                 excludeDumps=number < len(chain) - 1)
+        if failure is not None:
+            print "Restore failed: %s" % failure
+            return 1
+    print "Restored %d backups." % len(chain)
+    return 0
+
+def removeIfExists(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+def printDumps(dumps):
+    """Print the size and time taken of each of dumps, a list of
+    (database, bytes, seconds)."""
+    for database, size, seconds in sorted(dumps):
+        print "Dumped %s: %d bytes in %.1f seconds" % (database, size,
+                                                       seconds)
+
 ######################################################################
 
 def main(argv=None):
@@ -54,6 +530,38 @@ def main(argv=None):
     parser.add_option("-D", "--skipDatabaseBackup",
                       action="store_false", dest="backupDatabase", default=True,
                       help="Skip backup of database")
+    parser.add_option("--dumpJobs", dest="dumpJobs", type="int", default=1,
+                      help="Dump N databases at once (default %default)",
+                      metavar="N")
+    parser.add_option("-s", "--stream",
+                      action="store_true", dest="stream", default=False,
+                      help="Stream tarball via ssh without a local copy")
+    parser.add_option("-C", "--compressor", dest="compressor",
+                      default="gzip", type="choice",
+                      choices=["gzip", "zlib", "zstd", "none"],
+                      help="Compress with gzip, zlib, zstd or none"
+                      " (default %default)")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="Compress with N threads (default %default)",
+                      metavar="N")
+    parser.add_option("-F", "--full",
+                      action="store_true", dest="full", default=False,
+                      help="Make a full backup, not an incremental one")
+    parser.add_option("--restore",
+                      action="store_true", dest="restore", default=False,
+                      help="Restore the latest full backup and the"
+                      " incremental ones after it, in order")
+    parser.add_option("--restoreTo", dest="restoreTo", default=".",
+                      help="Restore into DIR (default %default)",
+                      metavar="DIR")
+    parser.add_option("--restoreUntil", dest="restoreUntil", default=None,
+                      help="Restore up to and including backup NAME",
+                      metavar="NAME")
+    parser.add_option("--restoreHost", dest="restoreHost",
+                      default=socket.gethostname(),
+                      help="Restore backups of HOST (default %default)",
+                      metavar="HOST")
     (options, args) = parser.parse_args(argv)
     # Remove script name from arguments
     args.pop(0)
@@ -62,46 +570,98 @@ def main(argv=None):
     config = ConfigParser.ConfigParser()
     for fp in [open(file) for file in args]:
         config.readfp(fp)
+    if options.restore:
+        return restore(config.get("scp", "dest"), options.restoreHost,
+                       options.restoreTo, options.restoreUntil)
     # Create temporary working directory with tarball
     workingDir = tempfile.mkdtemp()
     atexit.register(os.rmdir, workingDir)
-    tarfile = os.path.join(workingDir,
-                           "backup-%s-%s.tar.gz" % (socket.gethostname(),
-                                                    time.strftime("%y%m%d")))
+    suffix, command = compressCmd(options.compressor, options.jobs)
+    if command is None and options.compressor != "zlib":
+        print "%s is not installed, compressing with zlib." % (
+            options.compressor == "gzip" and "pigz" or "zstd")
+    tarOptions = []
+    if config.has_section("incremental"):
+        snapshotFile = config.get("incremental", "snapshotFile")
+        # Touched after each full backup
+        fullMarker = snapshotFile + ".full"
+        fullEvery = 7
+        if config.has_option("incremental", "fullEvery"):
+            fullEvery = config.getfloat("incremental", "fullEvery")
+        full = (options.full or not os.path.exists(snapshotFile)
+                or not os.path.exists(fullMarker)
+                or time.time() - os.path.getmtime(fullMarker) >
+                fullEvery * 86400)
+        # tar updates the snapshot, so give it a copy to keep if all
+        # goes well
+        newSnapshot = snapshotFile + ".new"
+        removeIfExists(newSnapshot)
+        atexit.register(removeIfExists, newSnapshot)
+        if not full:
+            shutil.copyfile(snapshotFile, newSnapshot)
+        tarOptions.append("--listed-incremental=%s" % newSnapshot)
+        print "Making %s backup." % (full and "full" or "incremental")
+        tarName = "backup-%s-%s-%s.tar%s" % (
+            socket.gethostname(), time.strftime("%y%m%d-%H%M%S"),
+            full and "full" or "incr", suffix)
+    else:
+        tarName = "backup-%s-%s.tar%s" % (socket.gethostname(),
+                                          time.strftime("%y%m%d"), suffix)
+    tarfile = os.path.join(workingDir, tarName)
     # Paths we will be including in tarball
     pathsToBackup = []
     pathsToBackup.append(config.get("web", "confDir"))
     pathsToBackup.append(config.get("web", "dataDir"))
+    databases = []
+    mysqlOptions = []
     if options.backupDatabase:
-        print "Dumping database."
-        databaseBackup = os.path.join(workingDir, "databaseBackup.sql")
-        atexit.register(os.remove, databaseBackup)
-        with open(databaseBackup, "w") as backupFD:
-            pipe = subprocess.Popen(["/usr/bin/mysqldump",
-                                     "--user=%s" % config.get("database",
-                                                              "user"),
-                                     "--password=%s" % config.get("database",
-                                                                  "password"),
-                                     "--all-databases"],
-                                    stdout=backupFD)
-            pipe.wait()
-            if pipe.returncode != 0:
-                print "Database dump failed."
-                return 1
-        pathsToBackup.append(databaseBackup)
-    print "Running tar...."
-    print "Backing up: " + " ".join(pathsToBackup)
-    runCmd(["tar", "cfzP", tarfile] + pathsToBackup)
-    atexit.register(os.remove, tarfile)
+        mysqlOptions = ["--user=%s" % config.get("database", "user"),
+                        "--password=%s" % config.get("database", "password")]
+        try:
+            databases = listDatabases(mysqlOptions)
+        except ArchiveException, e:
+            print "Database dump failed: %s" % e
+            return 1
+        print "Dumping databases: " + " ".join(databases)
     scpDest = config.get("scp", "dest")
-    print "Backing up tarfile via scp to %s..." % scpDest
-    runCmd(["scp",
-            # Use blowfish for speed
-            "-c", "blowfish",
-            # Batch mode, no passwords or other prompts
-            "-B",
-            tarfile,
-            scpDest])
+    print "Backing up: " + " ".join(pathsToBackup)
+    def start(output):
+        return startArchive(output, options.compressor, options.jobs,
+                            pathsToBackup, databases, mysqlOptions,
+                            options.dumpJobs, tarOptions)
+    if options.stream:
+        dest = splitDest(scpDest)
+        if dest is None:
+            print "Destination %s is not of the form host:path" % scpDest
+            return 1
+        host, destDir = dest
+        remotePath = destDir and os.path.join(destDir, tarName) or tarName
+        print "Streaming tarball via ssh to %s:%s..." % (host, remotePath)
+        pipeline = start(subprocess.PIPE)
+        try:
+            hexdigest, size = streamBackup(pipeline, host, remotePath)
+        except StreamException, e:
+            print "Backup failed: %s" % e
+            return 1
+        printDumps(pipeline[0][1].dumps)
+        print "Sent %d bytes, SHA-256 %s" % (size, hexdigest)
+    else:
+        print "Running tar...."
+        atexit.register(os.remove, tarfile)
+        with open(tarfile, "wb") as output:
+            pipeline = start(output)
+            failure = failedPipeline(pipeline)
+        if failure is not None:
+            print "Backup failed: %s" % failure
+            return 1
+        printDumps(pipeline[0][1].dumps)
+        print "Backing up tarfile via scp to %s..." % scpDest
+        runCmd(["scp"] + SSH_OPTIONS + [tarfile, scpDest])
+    if tarOptions:
+        # The next incremental backup follows on from this one
+        os.rename(newSnapshot, snapshotFile)
+        if full:
+            open(fullMarker, "w").close()
     print "Success."
     return 0
 
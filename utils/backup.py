@@ -7,6 +7,23 @@ Example ~/.backup.conf:
 
 [Options]
 ExcludesFile=~/.backup.excludes
+# Number of sources to back up at once (default 1), may be overridden
+# with --jobs. Each rsync logs to its own file, and the logs and the
+# output of rsync are merged into backup.log on the target when all
+# are done.
+Jobs=2
+# rsync normally skips files whose size and modification time match.
+# An index of the size, modification time and inode of every source
+# file, for each target, is kept in this directory (the default), and
+# files replaced with one of the same size and time are verified by
+# checksum. Every file is checksummed in an audit, run with --audit or
+# when the last was more than AuditDays ago.
+IndexDirectory=~/.backup-index
+AuditDays=30
+# Statistics of each backup of each source are appended to this file
+# as JSON, one object per line (default backup-history.jsonl on the
+# target), and used by --estimate to predict how long a backup takes.
+HistoryFile=~/.backup-history.jsonl
 
 [Target]
 # One or more possible target volumes. Will be check in order.
@@ -17,14 +34,34 @@ path1=/Volumes/Backup
 # One or more possible source volumes. Names do not matter.
 path1=/Users/username
 path2=/Users/username2
+
+[Snapshots]
+# If present, each backup is a dated snapshot in snapshots/ on the
+# target instead of a single mirror. Files unchanged since the previous
+# snapshot are hard links to it, so cost no space or copying. Old
+# snapshots are pruned keeping the newest of each of the last Hourly
+# hours, Daily days and Weekly weeks with snapshots (defaults 24, 7
+# and 4). A missing source fails the backup, leaving the snapshot
+# incomplete, so a snapshot without it never becomes the latest.
+Hourly=24
+Daily=7
+Weekly=4
 """
 import ConfigParser
+import datetime
+import json
 from optparse import OptionParser
 import os
 import os.path
+import re
 import shutil
+import sqlite3
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 def message_normal(msg):
     """Display a message."""
@@ -39,6 +76,615 @@ def error_message(msg):
     # Todo: should go to STDERR
     print msg
 
+class FileIndex:
+    """Index of the size, modification time and inode of each file in a
+    source as of its last successful backup, in a SQLite database.
+
+    rsync skips a file whose size and modification time have not
+    changed, so a file replaced by a different one with the same size
+    and time is missed. The index finds such files by their new inode
+    so only they need to be checksummed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        # Opened by main() but used by the thread running the job
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.text_factory = str
+        for table in ["files", "scan"]:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS %s (
+                                  path BLOB PRIMARY KEY,
+                                  size INTEGER, mtime_ns INTEGER,
+                                  dev INTEGER, ino INTEGER)""" % table)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS audits (
+                              time REAL)""")
+        self._db.commit()
+
+    def audit_due(self, days):
+        """Is the last audit more than days ago, or has there been none?"""
+        row = self._db.execute("SELECT max(time) FROM audits").fetchone()
+        return row[0] is None or time.time() - row[0] > days * 86400
+
+    def _walk(self, source_path):
+        """Yield (relative path, stat, indexed (size, mtime_ns, dev, ino)
+        or None) for each regular file under source_path."""
+        for directory, subdirectories, files in os.walk(source_path):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                relative = os.path.relpath(path, source_path)
+                row = self._db.execute(
+                    "SELECT size, mtime_ns, dev, ino FROM files WHERE path=?",
+                    (sqlite3.Binary(relative),)).fetchone()
+                yield relative, st, row
+
+    def scan(self, source_path):
+        """Record the files under source_path and return the paths,
+        relative to source_path, of those with the size and modification
+        time in the index but a different inode.
+
+        The files are recorded apart from the index until commit()."""
+        suspects = []
+        records = []
+        self._db.execute("DELETE FROM scan")
+        for relative, st, row in self._walk(source_path):
+            mtime_ns = long(st.st_mtime * 1000000000)
+            records.append((sqlite3.Binary(relative), st.st_size,
+                            mtime_ns, st.st_dev, st.st_ino))
+            if (row is not None and row[0:2] == (st.st_size, mtime_ns)
+                and row[2:4] != (st.st_dev, st.st_ino)):
+                suspects.append(relative)
+            if len(records) >= 1000:
+                self._flush_scan(records)
+        self._flush_scan(records)
+        self._db.commit()
+        return suspects
+
+    def _flush_scan(self, records):
+        self._db.executemany(
+            """INSERT INTO scan (path, size, mtime_ns, dev, ino)
+               VALUES (?, ?, ?, ?, ?)""", records)
+        del records[:]
+
+    def is_empty(self):
+        """Has no backup been recorded in the index?"""
+        return self._db.execute(
+            "SELECT count(*) FROM files").fetchone()[0] == 0
+
+    def changes(self, source_path):
+        """Compare the files under source_path with the index, without
+        changing it, and return a dictionary of statistics named as
+        parse_rsync_statistic() names them, of what rsync would copy:
+        new files and those with a different size, modification time or
+        inode. "deleted" is the number of indexed files now gone."""
+        statistics = {"files" : 0, "total_size" : 0,
+                      "files_transferred" : 0, "transferred_size" : 0}
+        indexed = 0
+        for relative, st, row in self._walk(source_path):
+            statistics["files"] += 1
+            statistics["total_size"] += st.st_size
+            if row is not None:
+                indexed += 1
+            if row is None or row != (st.st_size,
+                                      long(st.st_mtime * 1000000000),
+                                      st.st_dev, st.st_ino):
+                statistics["files_transferred"] += 1
+                statistics["transferred_size"] += st.st_size
+        statistics["deleted"] = self._db.execute(
+            "SELECT count(*) FROM files").fetchone()[0] - indexed
+        return statistics
+
+    def commit(self, audited=False):
+        """Replace the index with the last scan, after a successful
+        backup, noting an audit if audited."""
+        self._db.execute("DELETE FROM files")
+        self._db.execute("INSERT INTO files SELECT * FROM scan")
+        self._db.execute("DELETE FROM scan")
+        if audited:
+            self._db.execute("INSERT INTO audits (time) VALUES (?)",
+                             (time.time(),))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+# Lines of rsync --stats output: (regular expression, statistic, type).
+# Numbers have thousands separators from rsync 3.1, and older versions
+# say "Number of files transferred".
+_NUMBER = r"([\d,]+)"
+RSYNC_STATISTICS = [
+    (r"Number of files: " + _NUMBER, "files", long),
+    (r"Number of (?:regular )?files transferred: " + _NUMBER,
+     "files_transferred", long),
+    (r"Total file size: " + _NUMBER, "total_size", long),
+    (r"Total transferred file size: " + _NUMBER, "transferred_size", long),
+    (r"Literal data: " + _NUMBER, "literal_data", long),
+    (r"Matched data: " + _NUMBER, "matched_data", long),
+    (r"Total bytes sent: " + _NUMBER, "bytes_sent", long),
+    (r"Total bytes received: " + _NUMBER, "bytes_received", long),
+    (r"total size is \S+\s+speedup is ([\d,.]+)", "speedup", float),
+]
+RSYNC_STATISTICS = [(re.compile("^" + pattern), name, convert)
+                    for pattern, name, convert in RSYNC_STATISTICS]
+
+def parse_rsync_statistic(line, statistics):
+    """Add a statistic from a line of rsync --stats output, if it is
+    one, to the dictionary statistics."""
+    for pattern, name, convert in RSYNC_STATISTICS:
+        match = pattern.match(line)
+        if match:
+            statistics[name] = convert(match.group(1).replace(",", ""))
+            return
+
+class RsyncJob:
+    """Backing up a source path to a target path with rsync.
+
+    The job runs in a thread of its own. If it has a FileIndex and is
+    not an audit, the source is scanned first and files the index finds
+    replaced are checksummed by a second rsync after the first."""
+
+    def __init__(self, name, source_path, target_path, arguments, log_file,
+                 index=None, audit=False, verify_arguments=None, echo=True):
+        self.name = name
+        self.source_path = source_path
+        self.target_path = target_path
+        self.arguments = arguments
+        self.log_file = log_file
+        # rsync's own output, when it is not shown, is kept apart from
+        # log_file, which rsync writes to itself
+        self.output_file = os.path.splitext(log_file)[0] + ".out"
+        self.index = index
+        self.audit = audit
+        # rsync arguments for checking files, less the file list,
+        # source and target
+        self.verify_arguments = verify_arguments
+        # Show rsync's output if not sent elsewhere
+        self.echo = echo
+        self.verified = 0
+        # Parsed from the rsync --stats output of the main run
+        self.statistics = {}
+        self.started = None
+        self.scan_seconds = None
+        self.wall_seconds = None
+        self.process = None
+        self.return_code = None
+        self.error = None
+        self._thread = None
+        self._cancelled = False
+
+    def start(self, output=None):
+        """Start the job, with rsync's output going to the file object
+        output, or inherited if None."""
+        self._thread = threading.Thread(target=self._run, args=(output,))
+        self._thread.start()
+
+    def _call(self, arguments, output, statistics=None):
+        """Run rsync and return its exit status. If statistics is a
+        dictionary, rsync's standard output is read and parsed into
+        it on its way to output."""
+        if self._cancelled:
+            return -1
+        if statistics is None:
+            self.process = subprocess.Popen(arguments, stdout=output,
+                                            stderr=subprocess.STDOUT
+                                            if output is not None else None)
+            return self.process.wait()
+        self.process = subprocess.Popen(arguments, stdout=subprocess.PIPE,
+                                        stderr=output)
+        if output is None and self.echo:
+            output = sys.stdout
+        for line in iter(self.process.stdout.readline, ""):
+            parse_rsync_statistic(line, statistics)
+            if output is not None:
+                output.write(line)
+                output.flush()
+        self.process.stdout.close()
+        return self.process.wait()
+
+    def _run(self, output):
+        self.started = time.time()
+        try:
+            suspects = []
+            if self.index is not None:
+                suspects = self.index.scan(self.source_path)
+            self.scan_seconds = time.time() - self.started
+            return_code = self._call(self.arguments, output, self.statistics)
+            if return_code == 0 and suspects and not self.audit:
+                return_code = self._verify(suspects, output)
+            if return_code == 0 and self.index is not None:
+                self.index.commit(self.audit)
+            self.return_code = return_code
+        except Exception, e:
+            self.error = e
+            self.return_code = -1
+        self.wall_seconds = time.time() - self.started
+
+    def history(self):
+        """Return a dictionary describing the job for the history file."""
+        record = {
+            "name" : self.name,
+            "source" : self.source_path,
+            "target" : self.target_path,
+            "started" : self.started and datetime.datetime.fromtimestamp(
+                self.started).isoformat(),
+            "return_code" : self.return_code,
+            "error" : self.error and str(self.error),
+            "audit" : self.audit,
+            "verified" : self.verified,
+            "scan_seconds" : self.scan_seconds,
+            "wall_seconds" : self.wall_seconds,
+            }
+        record.update(self.statistics)
+        return record
+
+    def _verify(self, paths, output):
+        """Checksum paths, relative to the source, against the target."""
+        self.verified = len(paths)
+        files_from = tempfile.NamedTemporaryFile(prefix="backup-verify")
+        try:
+            files_from.write("\0".join(paths))
+            files_from.flush()
+            return self._call(
+                self.verify_arguments + [
+                    "--from0", "--files-from=%s" % files_from.name,
+                    os.path.join(self.source_path, ""),
+                    os.path.join(self.target_path,
+                                 os.path.basename(self.source_path), "")],
+                output)
+        finally:
+            files_from.close()
+
+    def poll(self):
+        """Return True if the job has finished."""
+        return not self._thread.is_alive()
+
+    def cancel(self):
+        """Stop the job and wait for it."""
+        self._cancelled = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+        self._thread.join()
+
+def run_jobs(jobs, concurrency, message):
+    """Run RsyncJobs, at most concurrency at a time, until all are done.
+
+    When more than one runs at once, the output of each goes to its
+    output file so they do not interleave."""
+    pending = list(jobs)
+    running = []
+    outputs = {}
+    try:
+        while pending or running:
+            while pending and len(running) < concurrency:
+                job = pending.pop(0)
+                message("Backing up %s to %s" % (job.source_path,
+                                                  job.target_path))
+                output = None
+                if concurrency > 1:
+                    output = outputs[job] = open(job.output_file, "w")
+                job.start(output)
+                running.append(job)
+            time.sleep(0.2)
+            for job in [job for job in running if job.poll()]:
+                running.remove(job)
+                if job in outputs:
+                    outputs.pop(job).close()
+                message("Finished %s" % job.source_path)
+    finally:
+        for job in running:
+            job.cancel()
+        for output in outputs.values():
+            output.close()
+
+def merge_logs(jobs, log_file):
+    """Append the log file and then the output file of each of jobs to
+    log_file, in order, and remove them."""
+    log = open(log_file, "a")
+    try:
+        for job in jobs:
+            log.write("=== %s to %s: rsync exited with %s ===\n" % (
+                    job.source_path, job.target_path, job.return_code))
+            for filename in [job.log_file, job.output_file]:
+                if not os.path.exists(filename):
+                    continue
+                job_log = open(filename)
+                try:
+                    shutil.copyfileobj(job_log, log)
+                finally:
+                    job_log.close()
+                os.remove(filename)
+    finally:
+        log.close()
+
+# Format of snapshot directory names, which sort by time
+SNAPSHOT_FORMAT = "%Y-%m-%d-%H%M%S"
+INCOMPLETE_SUFFIX = ".incomplete"
+
+# Retention: (option, default number kept, period of a snapshot)
+RETENTION = [
+    ("Hourly", 24, lambda t: (t.date(), t.hour)),
+    ("Daily", 7, lambda t: t.date()),
+    ("Weekly", 4, lambda t: t.isocalendar()[0:2]),
+]
+
+def list_snapshots(directory):
+    """Return a list of (datetime, path) of the complete snapshots in
+    directory, newest first."""
+    snapshots = []
+    for name in os.listdir(directory):
+        try:
+            snapshot_time = datetime.datetime.strptime(name, SNAPSHOT_FORMAT)
+        except ValueError:
+            continue
+        snapshots.append((snapshot_time, os.path.join(directory, name)))
+    snapshots.sort(reverse=True)
+    return snapshots
+
+def snapshots_to_keep(snapshots, retention):
+    """Return the set of paths of snapshots, a list of (datetime, path)
+    newest first, kept by retention, a list of (number, period).
+
+    The newest snapshot of each of the last number periods with
+    snapshots is kept for each entry, as is the newest snapshot of
+    all."""
+    keep = set(snapshots and [snapshots[0][1]] or [])
+    for number, period in retention:
+        periods = set()
+        for snapshot_time, path in snapshots:
+            key = period(snapshot_time)
+            if key in periods:
+                continue
+            if len(periods) == number:
+                break
+            periods.add(key)
+            keep.add(path)
+    return keep
+
+def prune_snapshots(directory, retention, message):
+    """Remove snapshots in directory not kept by retention."""
+    snapshots = list_snapshots(directory)
+    keep = snapshots_to_keep(snapshots, retention)
+    for snapshot_time, path in snapshots:
+        if path not in keep:
+            message("Removing snapshot %s" % path)
+            shutil.rmtree(path)
+
+def start_snapshot(directory):
+    """Return the path of a new incomplete snapshot in directory.
+
+    An incomplete snapshot left by a failed backup is reused, so only
+    what it is missing is copied."""
+    path = os.path.join(directory, datetime.datetime.now().strftime(
+            SNAPSHOT_FORMAT) + INCOMPLETE_SUFFIX)
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(INCOMPLETE_SUFFIX):
+            os.rename(os.path.join(directory, name), path)
+            break
+    else:
+        os.mkdir(path)
+    return path
+
+def finish_snapshot(path):
+    """Mark the incomplete snapshot at path complete and point the
+    "latest" link in its directory at it. Returns the path of the
+    complete snapshot."""
+    complete = path[:-len(INCOMPLETE_SUFFIX)]
+    os.rename(path, complete)
+    directory, name = os.path.split(complete)
+    latest = os.path.join(directory, "latest")
+    temporary = latest + INCOMPLETE_SUFFIX
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    os.symlink(name, temporary)
+    os.rename(temporary, latest)
+    return complete
+
+def append_history(history_file, jobs, snapshot=None):
+    """Append a line of JSON to history_file for each of jobs, made into
+    the complete snapshot at path snapshot if not None."""
+    history = open(history_file, "a")
+    try:
+        for job in jobs:
+            record = job.history()
+            record["snapshot"] = snapshot
+            history.write(json.dumps(record, sort_keys=True) + "\n")
+    finally:
+        history.close()
+
+def dry_run(job):
+    """Return the statistics of an rsync --dry-run of job.
+
+    The target is compared as it is; when it does not exist yet, an
+    empty directory stands in for it so rsync counts every file. An
+    audit's -c is left out, as it would make rsync read every file on
+    both sides; estimate() allows for that reading instead."""
+    arguments = [argument for argument in job.arguments[:-1]
+                 if not argument.startswith("--log-file=")
+                 and argument not in ["-v", "-c"]]
+    arguments.append("--dry-run")
+    empty = None
+    target_path = job.target_path
+    if not os.path.isdir(target_path):
+        empty = target_path = tempfile.mkdtemp(prefix="backup-estimate")
+    statistics = {}
+    try:
+        devnull = open(os.devnull, "w")
+        try:
+            process = subprocess.Popen(arguments + [target_path],
+                                       stdout=subprocess.PIPE, stderr=devnull)
+            for line in iter(process.stdout.readline, ""):
+                parse_rsync_statistic(line, statistics)
+            process.stdout.close()
+            return_code = process.wait()
+        finally:
+            devnull.close()
+    finally:
+        if empty is not None:
+            os.rmdir(empty)
+    if return_code != 0:
+        raise IOError("rsync --dry-run exited with %s" % return_code)
+    return statistics
+
+def estimate_jobs(jobs, concurrency, method):
+    """Return a list of (method, statistics or exception) for each of
+    jobs, a list of RsyncJobs, found at most concurrency at a time.
+
+    method "index" compares each source with its FileIndex, "rsync"
+    runs rsync --dry-run, and "auto" uses the index where it has a
+    backup recorded and rsync otherwise."""
+    results = [None] * len(jobs)
+    pending = list(enumerate(jobs))
+    lock = threading.Lock()
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                number, job = pending.pop(0)
+            used = method
+            if used == "auto":
+                used = job.index.is_empty() and "rsync" or "index"
+            try:
+                if used == "index":
+                    results[number] = (used, job.index.changes(
+                            job.source_path))
+                else:
+                    results[number] = (used, dry_run(job))
+            except Exception, e:
+                results[number] = (used, e)
+    threads = [threading.Thread(target=worker)
+               for i in range(min(concurrency, len(jobs)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def read_history(history_file, audits=False):
+    """Return a dictionary of name to list of (bytes transferred,
+    seconds copying) of the successful backups in history_file,
+    oldest first. Audits, which read every file, are left out.
+
+    If audits, the audits are returned instead, with the bytes of all
+    the files, which they read, in place of the bytes transferred."""
+    history = {}
+    if not os.path.exists(history_file):
+        return history
+    size = audits and "total_size" or "transferred_size"
+    for line in open(history_file):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if (record.get("return_code") != 0
+            or bool(record.get("audit")) != audits
+            or record.get(size) is None
+            or record.get("wall_seconds") is None):
+            continue
+        seconds = record["wall_seconds"] - (record.get("scan_seconds") or 0)
+        history.setdefault(record["name"], []).append(
+            (record[size], max(seconds, 0)))
+    return history
+
+def fit_throughput(points):
+    """Return (overhead seconds, seconds per byte) fitted by least
+    squares to points, a list of (bytes, seconds), or None if empty.
+
+    With too few or too alike points for a line, or a line that makes
+    no sense, the overhead is taken as nothing and the average
+    throughput is used."""
+    if not points:
+        return None
+    n = float(len(points))
+    mean_bytes = sum([b for b, s in points]) / n
+    mean_seconds = sum([s for b, s in points]) / n
+    variance = sum([(b - mean_bytes) ** 2 for b, s in points])
+    if variance > 0:
+        slope = sum([(b - mean_bytes) * (s - mean_seconds)
+                     for b, s in points]) / variance
+        overhead = mean_seconds - slope * mean_bytes
+        if slope > 0 and overhead >= 0:
+            return overhead, slope
+    if mean_bytes > 0:
+        return 0.0, mean_seconds / mean_bytes
+    return mean_seconds, 0.0
+
+def makespan(durations, concurrency):
+    """Return how long durations take run in order, at most concurrency
+    at a time, each starting when the first of those running ends."""
+    slots = [0.0] * concurrency
+    for duration in durations:
+        slot = slots.index(min(slots))
+        slots[slot] += duration
+    return max(slots)
+
+def format_duration(seconds):
+    """Return seconds as H:MM:SS."""
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+
+def estimate(jobs, concurrency, method, history_file, message):
+    """Report how much backing up jobs would transfer and, from the
+    throughput of earlier backups in history_file, how long it would
+    take. Returns the exit status.
+
+    A job due an audit reads every file, which is estimated from the
+    earlier audits, or without any as copying every file."""
+    message("Estimating...")
+    results = estimate_jobs(jobs, concurrency, method)
+    history = read_history(history_file)
+    audit_history = read_history(history_file, audits=True)
+    # Sources with no history of their own go at the average rate
+    everything = fit_throughput(sum(history.values(), []))
+    every_audit = fit_throughput(sum(audit_history.values(), []))
+    durations = []
+    total = 0
+    failed = False
+    for job, (used, statistics) in zip(jobs, results):
+        if isinstance(statistics, Exception):
+            error_message("Error estimating %s: %s" % (job.source_path,
+                                                       statistics))
+            failed = True
+            continue
+        transferred = statistics.get("transferred_size", 0)
+        total += transferred
+        model = fit_throughput(history.get(job.name, [])) or everything
+        size = transferred
+        audit = ""
+        if job.audit:
+            size = statistics.get("total_size", 0)
+            model = (fit_throughput(audit_history.get(job.name, []))
+                     or every_audit or model)
+            audit = ", audit reading %d bytes" % size
+        duration = ""
+        if model is not None:
+            overhead, seconds_per_byte = model
+            durations.append(overhead + seconds_per_byte * size)
+            duration = ", about %s" % format_duration(durations[-1])
+        deleted = ""
+        if "deleted" in statistics:
+            deleted = ", %d deleted" % statistics["deleted"]
+        message("%s: %d of %d files to transfer, %d bytes%s%s (%s)%s" % (
+                job.source_path, statistics.get("files_transferred", 0),
+                statistics.get("files", 0), transferred, deleted, audit,
+                used, duration))
+    if everything is None:
+        message("Estimated %d bytes to transfer. No earlier backups in %s"
+                " to estimate the time from." % (total, history_file))
+    else:
+        message("Estimated %d bytes to transfer in about %s with %d"
+                " jobs." % (total, format_duration(makespan(durations,
+                                                            concurrency)),
+                            concurrency))
+    if failed:
+        return 1
+    return 0
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -51,6 +697,22 @@ def main(argv=None):
                       help="use configuration from FILE", metavar="FILE")
     parser.add_option("-q", "--quiet", action="store_true", dest="quiet",
                       help="run quietly", default=False)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None,
+                      help="back up N sources at once (default from"
+                      " configuration, or 1)", metavar="N")
+    parser.add_option("--audit", action="store_true", dest="audit",
+                      default=False,
+                      help="compare every file by checksum")
+    parser.add_option("--estimate", action="store_true", dest="estimate",
+                      default=False,
+                      help="report what a backup would transfer and how long"
+                      " it would take, without doing it")
+    parser.add_option("--estimate-with", dest="estimate_with",
+                      default="auto", type="choice",
+                      choices=["auto", "index", "rsync"],
+                      help="find changes with the index, rsync --dry-run or,"
+                      " with auto, the index where it has a backup recorded"
+                      " (default %default)", metavar="METHOD")
     (options, args) = parser.parse_args()
     if options.quiet:
         message = message_quiet
@@ -73,6 +735,26 @@ def main(argv=None):
     except:
         pass
 
+    jobs = options.jobs
+    if jobs is None:
+        if config.has_option("Options", "Jobs"):
+            jobs = config.getint("Options", "Jobs")
+        else:
+            jobs = 1
+    if jobs < 1:
+        error_message("Number of jobs must be at least 1.")
+        return 1
+
+    index_directory = os.path.expanduser("~/.backup-index")
+    if config.has_option("Options", "IndexDirectory"):
+        index_directory = os.path.expanduser(
+            config.get("Options", "IndexDirectory"))
+    if not os.path.exists(index_directory):
+        os.makedirs(index_directory)
+    audit_days = None
+    if config.has_option("Options", "AuditDays"):
+        audit_days = config.getfloat("Options", "AuditDays")
+
     # Find target backup volume. Look in [Target] section. We ignore
     # names and just look at values.
     for name, target_volume in config.items("Target"):
@@ -84,49 +766,157 @@ def main(argv=None):
     message("Target path is %s" % target_volume)
 
     # Get list of directories to be backed up.
-    source_paths = [items[1] for items in config.items("Sources")]
-    if len(source_paths) == 0:
+    sources = config.items("Sources")
+    if len(sources) == 0:
         message("No source paths defined.")
         return 0
 
     log_file = os.path.join(target_volume, "backup.log")
-    if os.path.exists(log_file):
+    if os.path.exists(log_file) and not options.estimate:
         shutil.move(log_file, log_file + ".bak")
-                    
-    # Do it
-    count = 0
-    for source_path in source_paths:
+    history_file = os.path.join(target_volume, "backup-history.jsonl")
+    if config.has_option("Options", "HistoryFile"):
+        history_file = os.path.expanduser(
+            config.get("Options", "HistoryFile"))
+
+    # Back up into a new snapshot linked to the last, or over a mirror
+    snapshot = None
+    previous_snapshot = None
+    destination = target_volume
+    if config.has_section("Snapshots"):
+        snapshot_directory = os.path.join(target_volume, "snapshots")
+        if not os.path.exists(snapshot_directory):
+            os.makedirs(snapshot_directory)
+        snapshots = list_snapshots(snapshot_directory)
+        if snapshots:
+            previous_snapshot = snapshots[0][1]
+        if options.estimate:
+            # What is unchanged since the previous snapshot is linked,
+            # not copied, so compare with it
+            destination = previous_snapshot or os.path.join(
+                snapshot_directory, "estimate" + INCOMPLETE_SUFFIX)
+            previous_snapshot = None
+        else:
+            snapshot = destination = start_snapshot(snapshot_directory)
+            message("Snapshot is %s" % snapshot)
+
+    rsync_jobs = []
+    # Sources missing from a snapshot, which is then left incomplete
+    missing = []
+    for name, source_path in sources:
         source_path = os.path.expanduser(source_path)
         if not os.path.exists(source_path):
-            message("Source path \"%s\" does not exist." % source_path)
+            if snapshot is not None:
+                error_message("Source path \"%s\" does not exist." %
+                              source_path)
+                missing.append(source_path)
+            else:
+                message("Source path \"%s\" does not exist." % source_path)
             continue
-        count += 1
-        target_path = os.path.join(target_volume,
+        target_path = os.path.join(destination,
                                    os.path.dirname(source_path).lstrip(os.sep))
-        if not os.path.exists(target_path):
+        if not os.path.exists(target_path) and not options.estimate:
             os.makedirs(target_path)
-        message("Backing up %s to %s" % (source_path, target_path))
-        arguments = ["rsync"]
+        # Each rsync has its own log, merged into log_file at the end
+        job_log_file = os.path.join(target_volume, "backup.%s.log" %
+                                    re.sub(r"[^\w.-]", "_", name))
+        if os.path.exists(job_log_file) and not options.estimate:
+            os.remove(job_log_file)
+        # Each target volume has an index of its own, as each was
+        # last backed up at a different time
+        index = FileIndex(os.path.join(index_directory, "%s@%s.db" % (
+                    re.sub(r"[^\w.-]", "_", name),
+                    re.sub(r"[^\w.-]", "_", target_volume))))
+        audit = options.audit or (audit_days is not None and
+                                  index.audit_due(audit_days))
+        if audit and not options.estimate:
+            message("Auditing %s by checksum" % source_path)
         # -a: archive mode
         # -u: Update, don't copy older files
-        # -c: Use checksums instead of modification time and size -
-        # this seems to work better.
-        arguments.append("-auc")
+        # -c: Use checksums instead of modification time and size,
+        # which means reading every file on both sides, so only when
+        # auditing or verifying files the index has found replaced
+        flags = ["-au"]
         if not options.quiet:
-            arguments.append("-v")  # Verbose mode
+            flags.append("-v")  # Verbose mode
+        if excludes_file is not None:
+            flags.append("--exclude-from")
+            flags.append(excludes_file)
+        flags.append("--log-file=%s" % job_log_file)
+        arguments = ["rsync"] + flags
+        if audit:
+            arguments.append("-c")
+        arguments.append("--stats")
         arguments.append("--delete")
         arguments.append("--delete-excluded")
-        if excludes_file is not None:
-            arguments.append("--exclude-from")
-            arguments.append(excludes_file)
-        arguments.append("--log-file=%s" % log_file)
+        if previous_snapshot is not None:
+            # Files unchanged since the previous snapshot are hard linked
+            # to it rather than copied
+            arguments.append("--link-dest=%s" % os.path.join(
+                    previous_snapshot,
+                    os.path.dirname(source_path).lstrip(os.sep)))
         arguments.append(source_path)
         arguments.append(target_path)
-        return_code = subprocess.check_call(arguments)
-        if return_code != 0:
-            error_message("Error backing up %s" % source_path)
+        rsync_jobs.append(RsyncJob(name, source_path, target_path,
+                                   arguments, job_log_file, index, audit,
+                                   ["rsync", "-c"] + flags,
+                                   echo=not options.quiet))
+
+    if options.estimate:
+        try:
+            return estimate(rsync_jobs, jobs, options.estimate_with,
+                            history_file, message)
+        finally:
+            for job in rsync_jobs:
+                job.index.close()
 
-    message("Success. %d directories backed up." % count)
+    # Do it
+    completed = None
+    try:
+        try:
+            run_jobs(rsync_jobs, jobs, message)
+        finally:
+            merge_logs(rsync_jobs, log_file)
+            for job in rsync_jobs:
+                job.index.close()
+        failed = [job for job in rsync_jobs if job.return_code != 0]
+        if snapshot is not None and not failed and not missing:
+            completed = finish_snapshot(snapshot)
+    finally:
+        # An incomplete snapshot is renamed when it is completed, so
+        # only a complete one is recorded
+        append_history(history_file, rsync_jobs, completed)
+    for job in rsync_jobs:
+        statistics = job.statistics
+        if "files" in statistics:
+            message("%s: %d of %d files transferred, %d bytes sent,"
+                    " %d received, speedup %.2f, in %.1f seconds" % (
+                    job.source_path, statistics.get("files_transferred", 0),
+                    statistics["files"], statistics.get("bytes_sent", 0),
+                    statistics.get("bytes_received", 0),
+                    statistics.get("speedup", 0), job.wall_seconds))
+        if job.verified:
+            message("Verified %d replaced files in %s by checksum" % (
+                    job.verified, job.source_path))
+    for job in failed:
+        if job.error is not None:
+            error_message("Error backing up %s: %s" % (job.source_path,
+                                                       job.error))
+        else:
+            error_message("Error backing up %s (rsync exited with %s)" % (
+                    job.source_path, job.return_code))
+    if failed or missing:
+        if snapshot is not None:
+            message("Leaving %s to be completed next time" % snapshot)
+        return 1
+    if snapshot is not None:
+        retention = []
+        for option, number, period in RETENTION:
+            if config.has_option("Snapshots", option):
+                number = config.getint("Snapshots", option)
+            retention.append((number, period))
+        prune_snapshots(os.path.dirname(snapshot), retention, message)
+    message("Success. %d directories backed up." % len(rsync_jobs))
     return 0
 
 if __name__ == "__main__":
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""Benchmark the duplicate file finders on a synthetic tree
+
+%prog [<options>] <work directory>
+
+Generates a reproducible tree of files under the work directory and
+runs duplicate-files.py and dupinator.py over it in each of their
+modes, recording wall time, bytes read, peak RSS and, with --syscalls,
+the number of system calls. Results are appended to a JSON Lines file
+so runs with different options, or of different versions of the
+scripts, can be compared.
+
+dupinator.py changes the tree, so the tree is regenerated before each
+of its runs.
+"""
+import binascii
+import json
+from optparse import OptionParser
+import os
+import os.path
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+# Size distributions: (median, sigma of log of size, maximum)
+SIZES = {
+    "small" : (4 * 1024, 1.0, 1024 * 1024),
+    "mixed" : (64 * 1024, 2.0, 64 * 1024 * 1024),
+    "large" : (8 * 1024 * 1024, 1.0, 256 * 1024 * 1024),
+}
+
+# Files per directory in a wide tree, nesting of a deep tree
+WIDE_FILES_PER_DIRECTORY = 1000
+DEEP_DEPTH = 32
+
+# Runs of the scanners: (name, script, arguments, fresh tree needed).
+# %(scratch)s is replaced by a scratch directory.
+MODES = [
+    ("duplicate-files", "duplicate-files", [], False),
+    ("duplicate-files-jobs4", "duplicate-files", ["--jobs", "4"], False),
+    ("duplicate-files-spill", "duplicate-files",
+     ["--spill-dir", "%(scratch)s"], False),
+    ("duplicate-files-cache-cold", "duplicate-files",
+     ["--cache", "%(scratch)s/cache.db"], False),
+    ("duplicate-files-cache-warm", "duplicate-files",
+     ["--cache", "%(scratch)s/cache.db"], False),
+    ("dupinator-hash", "dupinator",
+     ["--mode", "hardlink", "--compare", "never"], True),
+    ("dupinator-compare", "dupinator",
+     ["--mode", "hardlink", "--compare", "always"], True),
+]
+
+# Run in the child to write its I/O counters from /proc/self/io to the
+# file named by $DEDUP_BENCHMARK_IO when it exits.
+WRAPPER = """
+import atexit, os, sys
+def dump():
+    try:
+        data = open("/proc/self/io").read()
+    except IOError:
+        return
+    open(os.environ["DEDUP_BENCHMARK_IO"], "w").write(data)
+atexit.register(dump)
+sys.argv = sys.argv[1:]
+# As if run directly, so the script can import the modules next to it
+sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+execfile(sys.argv[0], {"__name__" : "__main__"})
+"""
+
+######################################################################
+
+def random_bytes(rng, count):
+    """Return count bytes from rng."""
+    if count == 0:
+        return ""
+    return binascii.unhexlify("%0*x" % (count * 2, rng.getrandbits(count * 8)))
+
+def file_path(index, shape):
+    """Return relative path of file number index in a tree of shape."""
+    if shape == "wide":
+        directory = "d%05d" % (index // WIDE_FILES_PER_DIRECTORY)
+    else:
+        directory = os.path.join(*["d%02d" % depth for depth in
+                                   range(index % DEEP_DEPTH + 1)])
+    return os.path.join(directory, "f%08d" % index)
+
+def generate_tree(root, files, sizes, duplicates, near_duplicates, shape,
+                  seed):
+    """Create a tree of files under root.
+
+    A fraction duplicates of files are copies of an earlier file and a
+    fraction near_duplicates are copies with one byte changed in the
+    middle, the rest have random contents and sizes from the SIZES
+    distribution named by sizes. The same arguments always give the
+    same tree. Returns the total number of bytes written."""
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    rng = random.Random(seed)
+    median, sigma, maximum = SIZES[sizes]
+    originals = []
+    total = 0
+    for index in xrange(files):
+        path = os.path.join(root, file_path(index, shape))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        choice = rng.random()
+        if originals and choice < duplicates:
+            shutil.copyfile(rng.choice(originals), path)
+        elif originals and choice < duplicates + near_duplicates:
+            original = rng.choice(originals)
+            shutil.copyfile(original, path)
+            size = os.path.getsize(path)
+            if size:
+                with open(path, "r+b") as f:
+                    f.seek(size // 2)
+                    byte = f.read(1)
+                    f.seek(size // 2)
+                    f.write(chr((ord(byte) + 1) % 256))
+        else:
+            size = min(int(rng.lognormvariate(0, sigma) * median), maximum)
+            with open(path, "wb") as f:
+                f.write(random_bytes(rng, size))
+            originals.append(path)
+        total += os.path.getsize(path)
+    return total
+
+def find_script(name):
+    """Return path to the script with the given name, which is next to
+    this one with or without a .py extension."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for candidate in [name + ".py", name]:
+        path = os.path.join(directory, candidate)
+        if os.path.exists(path):
+            return path
+    raise IOError("Cannot find %s in %s" % (name, directory))
+
+def drop_caches():
+    """Drop the page cache so runs start cold. Needs root on Linux."""
+    subprocess.check_call(["sync"])
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+def exit_status(status):
+    """Return the exit status of a process from a wait() status, or,
+    like subprocess, minus the number of the signal that killed it."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def run_scanner(script, arguments, tree, scratch):
+    """Run a scanner over tree and return a dictionary of measurements."""
+    io_file = os.path.join(scratch, "io")
+    if os.path.exists(io_file):
+        os.remove(io_file)
+    env = dict(os.environ)
+    env["DEDUP_BENCHMARK_IO"] = io_file
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        child = subprocess.Popen(
+            [sys.executable, "-c", WRAPPER, script] + arguments + [tree],
+            stdout=devnull, stderr=devnull, env=env)
+        pid, status, rusage = os.wait4(child.pid, 0)
+        wall = time.time() - start
+    result = {
+        "status" : exit_status(status),
+        "wall_seconds" : round(wall, 3),
+        "user_seconds" : round(rusage.ru_utime, 3),
+        "system_seconds" : round(rusage.ru_stime, 3),
+        # ru_maxrss is in kilobytes on Linux, bytes on Mac OS X
+        "peak_rss_bytes" : rusage.ru_maxrss *
+            (1 if sys.platform == "darwin" else 1024),
+        "bytes_read" : None,
+        "disk_bytes_read" : None,
+    }
+    if os.path.exists(io_file):
+        counters = dict([line.split(": ") for line in
+                         open(io_file).read().splitlines()])
+        result["bytes_read"] = int(counters["rchar"])
+        result["disk_bytes_read"] = int(counters["read_bytes"])
+    return result
+
+def count_syscalls(script, arguments, tree, scratch):
+    """Run a scanner over tree under strace and return the number of
+    system calls it made, or None if strace is not available."""
+    trace = os.path.join(scratch, "strace")
+    with open(os.devnull, "w") as devnull:
+        try:
+            subprocess.call(["strace", "-f", "-c", "-o", trace,
+                             sys.executable, script] + arguments + [tree],
+                            stdout=devnull, stderr=devnull)
+        except OSError:
+            return None
+    # Last line looks like: 100.00    0.012345     123456 total
+    match = re.search(r"^\S+\s+\S+\s+(?:\S+\s+)?(\d+)\s+(?:\d+\s+)?total$",
+                      open(trace).read(), re.MULTILINE)
+    if not match:
+        return None
+    return int(match.group(1))
+
+######################################################################
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    parser = OptionParser(
+        usage=__doc__, # printed with -h/--help
+        version="%prog 1.0" # automatically generates --version
+        )
+    parser.add_option("-n", "--files", dest="files", type="int",
+                      default=10000,
+                      help="number of files in tree (default %default)")
+    parser.add_option("--sizes", dest="sizes", default="small",
+                      type="choice", choices=sorted(SIZES.keys()),
+                      help="distribution of file sizes: %s (default %%default)"
+                      % ", ".join(sorted(SIZES.keys())))
+    parser.add_option("--duplicates", dest="duplicates", type="float",
+                      default=0.1,
+                      help="fraction of files which are duplicates"
+                      " (default %default)")
+    parser.add_option("--near-duplicates", dest="near_duplicates",
+                      type="float", default=0.05,
+                      help="fraction of files which differ from another"
+                      " by one byte (default %default)")
+    parser.add_option("--shape", dest="shape", default="wide",
+                      type="choice", choices=["wide", "deep"],
+                      help="shape of tree: wide (%d files per directory)"
+                      " or deep (up to %d levels) (default %%default)" %
+                      (WIDE_FILES_PER_DIRECTORY, DEEP_DEPTH))
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="seed for generating tree (default %default)")
+    parser.add_option("-m", "--modes", dest="modes", default=None,
+                      help="comma-separated modes to run (default all): %s"
+                      % ", ".join([mode[0] for mode in MODES]))
+    parser.add_option("-o", "--output", dest="output",
+                      default="dedup-benchmark.jsonl",
+                      help="append results to FILE (default %default)",
+                      metavar="FILE")
+    parser.add_option("--drop-caches", action="store_true",
+                      dest="drop_caches", default=False,
+                      help="drop the page cache before each run (needs root)")
+    parser.add_option("--syscalls", action="store_true", dest="syscalls",
+                      default=False,
+                      help="count system calls with an extra run of each"
+                      " mode under strace")
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("Work directory required")
+    work = os.path.abspath(args[0])
+    tree = os.path.join(work, "tree")
+    scratch = os.path.join(work, "scratch")
+    modes = MODES
+    if options.modes:
+        names = options.modes.split(",")
+        unknown = set(names) - set([mode[0] for mode in MODES])
+        if unknown:
+            parser.error("Unknown modes: %s" % ", ".join(sorted(unknown)))
+        for name in names:
+            # A warm mode reuses the cache its cold mode leaves behind
+            cold = name[:-len("-warm")] + "-cold"
+            if name.endswith("-warm") and cold not in names:
+                parser.error("%s needs %s to fill its cache first" % (name,
+                                                                      cold))
+        modes = [mode for mode in MODES if mode[0] in names]
+
+    tree_options = {
+        "files" : options.files,
+        "sizes" : options.sizes,
+        "duplicates" : options.duplicates,
+        "near_duplicates" : options.near_duplicates,
+        "shape" : options.shape,
+        "seed" : options.seed,
+    }
+    def generate():
+        print "Generating tree of %d files in %s..." % (options.files, tree)
+        return generate_tree(tree, **tree_options)
+    tree_bytes = generate()
+    fresh = True
+
+    output = open(options.output, "a")
+    print "%-28s %9s %9s %14s %12s %10s" % (
+        "Mode", "Status", "Wall (s)", "Read (bytes)", "RSS (KiB)",
+        "Syscalls")
+    for name, script_name, arguments, needs_fresh_tree in modes:
+        if os.path.exists(scratch) and not name.endswith("-warm"):
+            shutil.rmtree(scratch)
+        if not os.path.exists(scratch):
+            os.makedirs(scratch)
+        if needs_fresh_tree and not fresh:
+            generate()
+        fresh = not needs_fresh_tree
+        script = find_script(script_name)
+        arguments = [argument % {"scratch" : scratch}
+                     for argument in arguments]
+        if options.drop_caches:
+            drop_caches()
+        result = run_scanner(script, arguments, tree, scratch)
+        result["syscalls"] = None
+        if options.syscalls:
+            if needs_fresh_tree:
+                generate()
+            result["syscalls"] = count_syscalls(script, arguments, tree,
+                                                scratch)
+        record = {
+            "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host" : platform.node(),
+            "mode" : name,
+            "arguments" : arguments,
+            "tree" : dict(tree_options, bytes=tree_bytes),
+        }
+        record.update(result)
+        output.write(json.dumps(record, sort_keys=True) + "\n")
+        output.flush()
+        print "%-28s %9d %9.2f %14s %12d %10s" % (
+            name, result["status"], result["wall_seconds"],
+            result["bytes_read"], result["peak_rss_bytes"] // 1024,
+            result["syscalls"])
+    output.close()
+    print "Results appended to %s" % options.output
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
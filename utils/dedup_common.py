@@ -0,0 +1,373 @@
+"""Helpers shared by duplicate-files.py and dupinator.py
+
+Walking a tree, reading and hashing files, and caching digests between
+runs. This is a module, not a script: install.sh installs it next to
+the scripts, keeping its .py extension, so they can import it.
+"""
+import ctypes
+import ctypes.util
+import hashlib
+import io
+import mmap
+import os
+import os.path
+import Queue
+import sqlite3
+import stat
+import sys
+import threading
+import zlib
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        # Backport for Python 2: pip install pyblake2
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+try:
+    # pip install xxhash
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport for Python 2: pip install scandir
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# How update_hash() reads files, may be changed by the scripts'
+# options.
+BLOCK_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024
+KEEP_PAGE_CACHE = False
+
+def file_key(st):
+    """Return a key identifying the contents of a file from its stat.
+
+    The key changes whenever the file is replaced or modified."""
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = long(st.st_mtime * 1000000000)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+class HashCache:
+    """Persistent cache of file digests in a SQLite database.
+
+    Digests are keyed by the file_key() of a file and the type of the
+    digest, so a file is only rehashed if it has changed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._db = sqlite3.connect(filename)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS digests (
+                              dev INTEGER, ino INTEGER,
+                              size INTEGER, mtime_ns INTEGER,
+                              digest_type TEXT, digest TEXT, path TEXT,
+                              PRIMARY KEY (dev, ino, digest_type))""")
+
+    def get(self, key, digest_type):
+        """Return the cached digest for key or None."""
+        dev, ino, size, mtime_ns = key
+        row = self._db.execute(
+            """SELECT digest FROM digests
+               WHERE dev=? AND ino=? AND digest_type=?
+               AND size=? AND mtime_ns=?""",
+            (dev, ino, digest_type, size, mtime_ns)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return str(row[0])
+
+    def put(self, path, key, digest_type, digest):
+        """Store digest for the file at path with given key."""
+        dev, ino, size, mtime_ns = key
+        self._db.execute(
+            """INSERT OR REPLACE INTO digests
+               (dev, ino, size, mtime_ns, digest_type, digest, path)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (dev, ino, size, mtime_ns, digest_type, digest,
+             # Paths are stored as bytes as they need not be valid text
+             sqlite3.Binary(os.path.abspath(path))))
+
+    def evict(self, root):
+        """Remove entries under root for files deleted or changed."""
+        root = os.path.join(os.path.abspath(root), "")
+        stale = []
+        for row in self._db.execute(
+            """SELECT dev, ino, size, mtime_ns, digest_type, path
+               FROM digests WHERE substr(path, 1, ?) = ?""",
+            (len(root), sqlite3.Binary(root))):
+            dev, ino, size, mtime_ns, digest_type, path = row
+            try:
+                key = file_key(os.lstat(str(path)))
+            except OSError:
+                key = None
+            if key != (dev, ino, size, mtime_ns):
+                stale.append((dev, ino, digest_type))
+        self._db.executemany(
+            "DELETE FROM digests WHERE dev=? AND ino=? AND digest_type=?",
+            stale)
+        self.evicted += len(stale)
+
+    def forget(self, dev, ino):
+        """Remove all entries for an inode."""
+        cursor = self._db.execute("DELETE FROM digests WHERE dev=? AND ino=?",
+                                  (dev, ino))
+        self.evicted += cursor.rowcount
+
+    def close(self):
+        """Commit changes and close the cache."""
+        self._db.commit()
+        self._db.close()
+
+    def report(self):
+        """Return a human-readable report as a list of lines."""
+        return [
+            "Cache %s: %d hits, %d misses, %d entries evicted" % (
+                self.filename, self.hits, self.misses, self.evicted),
+            ]
+
+def fadvise(fd, advice):
+    """Give the kernel advice about how the whole of fd will be read.
+
+    Uses os.posix_fadvise() where it exists and libc otherwise. Does
+    nothing on platforms without posix_fadvise()."""
+    global _libc_fadvise
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        return
+    if not sys.platform.startswith("linux"):
+        return
+    if _libc_fadvise is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        _libc_fadvise = libc.posix_fadvise
+        _libc_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                                  ctypes.c_longlong, ctypes.c_int]
+    _libc_fadvise(fd, 0, 0, _FADVISE_LINUX[advice])
+
+_libc_fadvise = None
+_FADVISE_LINUX = {
+    "POSIX_FADV_SEQUENTIAL" : 2,
+    "POSIX_FADV_DONTNEED" : 4,
+}
+
+# Per-thread read buffer for update_hash()
+_buffers = threading.local()
+
+def read_buffer():
+    """Return this thread's buffer of BLOCK_SIZE bytes to read files
+    into."""
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) != BLOCK_SIZE:
+        buffer = _buffers.buffer = bytearray(BLOCK_SIZE)
+    return buffer
+
+def update_hash(hash, filename):
+    """Update hash with the contents of filename.
+
+    Files of at least MMAP_THRESHOLD bytes are mapped into memory,
+    smaller files are read BLOCK_SIZE bytes at a time into a buffer
+    which is reused between calls. Unless KEEP_PAGE_CACHE is set, the
+    kernel is told to drop the file from the page cache afterwards so
+    a scan does not push out the working set of other processes."""
+    with io.open(filename, "rb", buffering=0) as f:
+        fd = f.fileno()
+        fadvise(fd, "POSIX_FADV_SEQUENTIAL")
+        size = os.fstat(fd).st_size
+        if size and size >= MMAP_THRESHOLD:
+            m = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            try:
+                hash.update(m)
+            finally:
+                m.close()
+        else:
+            buffer = read_buffer()
+            view = memoryview(buffer)
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                hash.update(view[:count])
+        if not KEEP_PAGE_CACHE:
+            fadvise(fd, "POSIX_FADV_DONTNEED")
+
+class _Checksum:
+    """Give a zlib checksum function the interface of a hashlib object."""
+
+    def __init__(self, function):
+        self._function = function
+        self._value = function("")
+
+    def update(self, data):
+        if isinstance(data, memoryview):
+            # zlib only takes strings and old-style buffers
+            data = data.tobytes()
+        self._value = self._function(data, self._value)
+
+    def hexdigest(self):
+        return "%08x" % (self._value & 0xffffffff)
+
+# Digest algorithms: name : (constructor, strong). Strong digests are
+# trusted to confirm duplicates, the rest only to tell files apart.
+DIGESTS = {
+    "crc32" : (lambda: _Checksum(zlib.crc32), False),
+    "adler32" : (lambda: _Checksum(zlib.adler32), False),
+    "md5" : (hashlib.md5, True),
+    "sha1" : (hashlib.sha1, True),
+    "sha256" : (hashlib.sha256, True),
+}
+if blake2b is not None:
+    DIGESTS["blake2b"] = (blake2b, True)
+if xxhash is not None:
+    DIGESTS["xxh64"] = (xxhash.xxh64, False)
+
+# The fastest strong digest, and the fastest of all to tell files
+# apart, available
+if blake2b is not None:
+    DEFAULT_DIGEST = "blake2b"
+else:
+    DEFAULT_DIGEST = "sha1"
+if xxhash is not None:
+    DEFAULT_PREFILTER_DIGEST = "xxh64"
+else:
+    DEFAULT_PREFILTER_DIGEST = "crc32"
+
+def new_digest(name):
+    """Return a new hash object for the named algorithm in DIGESTS."""
+    return DIGESTS[name][0]()
+
+def list_directory(directory, skip=None):
+    """Return a tuple of a list of subdirectories of directory and a
+    list of (filename, key) for the regular files in it.
+
+    If given, skip(path, name, is_directory) is called for each
+    subdirectory and regular file, before any stat() of it, and those
+    for which it returns True are left out. Uses scandir() where
+    available, as it tells files and directories apart without a
+    stat() of each entry."""
+    subdirectories = []
+    files = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if skip is None or not skip(entry.path, entry.name, True):
+                        subdirectories.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    if skip is None or not skip(entry.path, entry.name,
+                                                False):
+                        files.append((entry.path, file_key(
+                                    entry.stat(follow_symlinks=False))))
+            except OSError:
+                # Vanished since the directory was listed
+                continue
+    else:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                if skip is None or not skip(path, name, True):
+                    subdirectories.append(path)
+            elif stat.S_ISREG(st.st_mode):
+                if skip is None or not skip(path, name, False):
+                    files.append((path, file_key(st)))
+    return subdirectories, files
+
+def walk_files(root, jobs=1, lister=list_directory):
+    """Yield (filename, key) for every regular file under root.
+
+    lister(directory) returns the subdirectories and files of a
+    directory as list_directory() does. Directories are passed around
+    only by it, so may be anything it takes, e.g. a path with state
+    from its parent, with root the first.
+
+    With more than one job, directories are listed by that many
+    threads, so the order of directories is not fixed, but the files in
+    a directory are always yielded together. Directories which cannot
+    be listed are skipped, like os.walk(), but any other exception from
+    lister is raised here whichever thread it happened in."""
+    if jobs < 2:
+        directories = [root]
+        while directories:
+            directory = directories.pop()
+            try:
+                subdirectories, files = lister(directory)
+            except OSError:
+                continue
+            for file in files:
+                yield file
+            directories.extend(reversed(subdirectories))
+        return
+
+    directories = Queue.Queue()
+    # Lists of files from each directory, sys.exc_info() of an error,
+    # or None when all are done
+    results = Queue.Queue(maxsize=jobs * 4)
+    lock = threading.Lock()
+    # Number of directories queued or being listed
+    outstanding = [1]
+    stop = threading.Event()
+    def worker():
+        while True:
+            directory = directories.get()
+            if directory is None:
+                break
+            subdirectories, files = [], []
+            try:
+                if not stop.is_set():
+                    try:
+                        subdirectories, files = lister(directory)
+                    except OSError:
+                        pass
+                with lock:
+                    outstanding[0] += len(subdirectories)
+                for subdirectory in subdirectories:
+                    directories.put(subdirectory)
+                if files:
+                    results.put(files)
+            except:
+                results.put(sys.exc_info())
+            finally:
+                with lock:
+                    outstanding[0] -= 1
+                    done = outstanding[0] == 0
+                if done:
+                    results.put(None)
+    threads = [threading.Thread(target=worker) for i in range(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    directories.put(root)
+    try:
+        while True:
+            files = results.get()
+            if files is None:
+                break
+            if isinstance(files, tuple):
+                raise files[0], files[1], files[2]
+            for file in files:
+                yield file
+    finally:
+        # Let the workers finish, discarding anything still to come
+        stop.set()
+        for thread in threads:
+            directories.put(None)
+        while [thread for thread in threads if thread.is_alive()]:
+            try:
+                results.get(timeout=0.1)
+            except Queue.Empty:
+                pass
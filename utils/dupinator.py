@@ -6,109 +6,793 @@ delete all duplicate files within the folders, leaving behind the
 first file found of any set of duplicates. It is designed to handle
 hundreds of thousands of files of any size at a time and to do so
 quickly. It was written to eliminate duplicates across several photo
-libraries that had been shared between users. As the script was a
-one-off to solve a very particular problem, there are no options nor
-is it refactoring into any kind of modules or reusable functions.
+libraries that had been shared between users.
+
+Use --mode to replace duplicates with hard links or reflinks to the
+original instead of deleting them, so every path keeps existing.
+
+Small sets of large files are confirmed by comparing them block by
+block, which stops at the first difference, and other sets by hashing
+them. Use --compare to choose.
+
+Use --cache to keep digests between runs so unchanged files are not
+read again.
+
+Files smaller than --min-size or larger than --max-size, and anything
+matching an --exclude glob or a rule in an --ignore-file (with the
+syntax of .gitignore), are skipped as the folders are walked, and
+excluded folders are not entered at all. Sets of sparse files, such as
+virtual machine images, are compared by their allocated extents so the
+holes in them are never read.
 
 From http://code.activestate.com/recipes/362459/"""
 
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import fnmatch
+import io
+from optparse import OptionParser
 import os
+import random
+import re
+import shutil
 import sys
-import stat
-import md5
+import time
+
+import dedup_common
+from dedup_common import (DIGESTS, HashCache, fadvise, list_directory,
+                          read_buffer, update_hash, walk_files)
 
 filesBySize = {}
 
-def walker(arg, dirname, fnames):
-    d = os.getcwd()
-    os.chdir(dirname)
-    try:
-        fnames.remove('Thumbs')
-    except ValueError:
-        pass        
-    for f in fnames:
-        if not os.path.isfile(f):
-            continue
-        size = os.stat(f)[stat.ST_SIZE]
-        if size < 100:
-            continue
-        if filesBySize.has_key(size):
-            a = filesBySize[size]
-        else:
-            a = []
-            filesBySize[size] = a
-        a.append(os.path.join(dirname, f))
-    os.chdir(d)
-
-for x in sys.argv[1:]:
-    print 'Scanning directory "%s"....' % x
-    os.path.walk(x, walker, filesBySize)    
-
-print 'Finding potential dupes...'
-potentialDupes = []
-potentialCount = 0
-trueType = type(True)
-sizes = filesBySize.keys()
-sizes.sort()
-for k in sizes:
-    inFiles = filesBySize[k]
-    outFiles = []
-    hashes = {}
-    if len(inFiles) is 1: continue
-    print 'Testing %d files of size %d...' % (len(inFiles), k)
-    for fileName in inFiles:
-        if not os.path.isfile(fileName):
-            continue
-        aFile = file(fileName, 'r')
-        hasher = md5.new(aFile.read(1024))
-        hashValue = hasher.digest()
-        if hashes.has_key(hashValue):
-            x = hashes[hashValue]
-            if type(x) is not trueType:
-                outFiles.append(hashes[hashValue])
-                hashes[hashValue] = True
-            outFiles.append(fileName)
+# Sets of files which compareFiles() is used for in "auto" mode, and
+# how much it reads of each file at a time.
+COMPARE_MAX_FILES = 3
+COMPARE_MIN_SIZE = 64 * 1024
+COMPARE_BLOCK_SIZE = 64 * 1024
+
+# What the walk skips unless told otherwise by options
+MIN_SIZE = 100
+DEFAULT_EXCLUDES = ["Thumbs"]
+
+def _translateIgnore(pattern):
+    """Return a regular expression for a .gitignore glob pattern, in
+    which * and ? do not match a slash and ** matches any number of
+    directories."""
+    i = 0
+    n = len(pattern)
+    out = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif c == "*":
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[" and pattern.find("]", i + 2) != -1:
+            j = pattern.find("]", i + 2)
+            chars = pattern[i + 1:j].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            out.append("[%s]" % chars)
+            i = j + 1
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
         else:
-            hashes[hashValue] = fileName
+            out.append(re.escape(c))
+            i += 1
+    return "".join(out)
+
+def parseIgnoreLine(line):
+    """Return (regex, negate, directoryOnly) for a line of an ignore
+    file, or None for a blank line or comment.
+
+    regex matches paths relative to the directory of the ignore file.
+    As in .gitignore, a pattern with a slash other than at its end is
+    anchored to that directory, otherwise it matches a name at any
+    depth."""
+    line = line.rstrip("\r\n").rstrip()
+    if not line or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    elif line.startswith("\\"):
+        line = line[1:]
+    directoryOnly = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    if "/" in line:
+        regex = "^" + _translateIgnore(line.lstrip("/")) + "$"
+    else:
+        regex = "^(?:.*/)?" + _translateIgnore(line) + "$"
+    return re.compile(regex), negate, directoryOnly
+
+class WalkFilter:
+    """Decide what a walk skips.
+
+    Files outside minSize to maxSize bytes are skipped, as is anything
+    whose name, or whose path if the pattern has a slash, matches one
+    of the glob patterns in excludes. Ignore files named in ignoreFiles
+    are read from each directory walked and apply to it and everything
+    under it, the last matching rule winning as in .gitignore."""
+
+    def __init__(self, minSize=0, maxSize=None, excludes=(),
+                 ignoreFiles=()):
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.excludes = list(excludes)
+        self.ignoreFiles = list(ignoreFiles)
+
+    def rules(self, directory, inherited=()):
+        """Return the ignore rules in force in directory, given those in
+        force in its parent, as a tuple of (directory, regex, negate,
+        directoryOnly)."""
+        rules = inherited
+        for name in self.ignoreFiles:
+            try:
+                f = open(os.path.join(directory, name))
+            except IOError:
+                continue
+            try:
+                parsed = [parseIgnoreLine(line) for line in f]
+            finally:
+                f.close()
+            rules = rules + tuple([(directory,) + rule
+                                   for rule in parsed if rule is not None])
+        return rules
+
+    def skip(self, path, name, isDirectory, rules):
+        """Should the file or directory at path be skipped?"""
+        for pattern in self.excludes:
+            if "/" in pattern:
+                if fnmatch.fnmatch(path, pattern):
+                    return True
+            elif fnmatch.fnmatch(name, pattern):
+                return True
+        for directory, regex, negate, directoryOnly in reversed(rules):
+            if directoryOnly and not isDirectory:
+                continue
+            relative = path[len(directory):].lstrip(os.sep)
+            if os.sep != "/":
+                relative = relative.replace(os.sep, "/")
+            if regex.match(relative):
+                return not negate
+        return False
+
+    def wantSize(self, size):
+        """Is a file of size bytes to be considered?"""
+        return size >= self.minSize and (self.maxSize is None or
+                                         size <= self.maxSize)
+
+def listDirectory(directory, walkFilter, rules=()):
+    """Return a tuple of a list of (subdirectory, rules) for the
+    subdirectories of directory and a list of (fileName, key) for the
+    regular files in it, leaving out anything walkFilter skips.
+
+    rules are the ignore rules in force in the parent of directory, and
+    those returned with each subdirectory the ones in force in
+    directory."""
+    rules = walkFilter.rules(directory, rules)
+    def skip(path, name, isDirectory):
+        return walkFilter.skip(path, name, isDirectory, rules)
+    subdirectories, files = list_directory(directory, skip)
+    return ([(subdirectory, rules) for subdirectory in subdirectories],
+            [(fileName, key) for fileName, key in files
+             if walkFilter.wantSize(key[2])])
+
+def walkFiles(path, walkFilter, jobs=1):
+    """Yield (fileName, key) for every regular file under path that
+    walkFilter does not skip.
+
+    With more than one job, directories are listed by that many
+    threads and the order of directories is not fixed."""
+    return walk_files((path, ()), jobs,
+                      lambda item: listDirectory(item[0], walkFilter, item[1]))
+
+def _walkOrder(f):
+    """Sort key putting files nearer the top of the tree first, so the
+    shallowest copy of a file is kept whatever order it was found in."""
+    fileName, key = f
+    return (fileName.count(os.sep), fileName)
+
+# lseek() whence values finding the data and holes of sparse files,
+# from Linux's unistd.h where the os module lacks them
+if sys.platform.startswith("linux"):
+    SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+    SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+else:
+    SEEK_DATA = getattr(os, "SEEK_DATA", None)
+    SEEK_HOLE = getattr(os, "SEEK_HOLE", None)
+
+def isSparse(fileName):
+    """Does fileName have less space allocated than its size?"""
+    st = os.lstat(fileName)
+    blocks = getattr(st, "st_blocks", None)
+    return blocks is not None and blocks * 512 < st.st_size
+
+def dataExtents(fd, size):
+    """Return a tuple of (offset, length) for the parts of the file open
+    as fd holding data, the rest being holes which read as zeros.
+
+    Where holes cannot be found the whole file is one extent."""
+    whole = size and ((0, size),) or ()
+    if SEEK_DATA is None:
+        return whole
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError, e:
+                if e.errno == errno.ENXIO:
+                    # Nothing but a hole from offset to the end
+                    break
+                raise
+            end = os.lseek(fd, start, SEEK_HOLE)
+            extents.append((start, end - start))
+            offset = end
+    except OSError, e:
+        if e.errno != errno.EINVAL:
+            raise
+        return whole
+    return tuple(extents)
+
+def extentMap(fileName):
+    """Return dataExtents() of fileName."""
+    f = io.open(fileName, "rb", buffering=0)
+    try:
+        return dataExtents(f.fileno(), os.fstat(f.fileno()).st_size)
+    finally:
+        f.close()
+
+def updateHashExtents(hasher, fileName):
+    """Update hasher with the data extents of fileName and the data in
+    them, without reading the holes between them.
+
+    Files with the same extents and data have the same contents, but a
+    file with holes and a copy with the zeros written out hash
+    differently."""
+    aFile = io.open(fileName, "rb", buffering=0)
+    try:
+        fd = aFile.fileno()
+        extents = dataExtents(fd, os.fstat(fd).st_size)
+        hasher.update("%d extents\n" % len(extents))
+        hasher.update("".join(["%d+%d\n" % extent for extent in extents]))
+        buffer = read_buffer()
+        view = memoryview(buffer)
+        for offset, length in extents:
+            aFile.seek(offset)
+            while length > 0:
+                count = aFile.readinto(view[:min(length, len(buffer))])
+                if not count:
+                    break
+                hasher.update(view[:count])
+                length -= count
+        if not dedup_common.KEEP_PAGE_CACHE:
+            fadvise(fd, "POSIX_FADV_DONTNEED")
+    finally:
+        aFile.close()
+
+# Digests of the first 1024 bytes and of whole files, may be changed
+# by options.
+DIGEST = dedup_common.DEFAULT_DIGEST
+PREFILTER_DIGEST = dedup_common.DEFAULT_PREFILTER_DIGEST
+
+def hashFile(fileName, key, cache, headOnly=False, extents=False):
+    """Return the DIGEST of a file, or the PREFILTER_DIGEST of its first
+    1024 bytes if headOnly, or the DIGEST of its data extents, see
+    updateHashExtents(), if extents.
+
+    The digest is looked up in and added to cache, if not None."""
+    if headOnly:
+        algorithm = PREFILTER_DIGEST
+        digestType = "%s-head-1024" % algorithm
+    elif extents:
+        algorithm = DIGEST
+        digestType = "%s-extents" % algorithm
+    else:
+        algorithm = DIGEST
+        digestType = algorithm
+    if cache is not None:
+        hashValue = cache.get(key, digestType)
+        if hashValue is not None:
+            return hashValue
+    hasher = DIGESTS[algorithm][0]()
+    if headOnly:
+        aFile = file(fileName, 'rb')
+        hasher.update(aFile.read(1024))
         aFile.close()
-    if len(outFiles):
-        potentialDupes.append(outFiles)
-        potentialCount = potentialCount + len(outFiles)
-del filesBySize
+    elif extents:
+        updateHashExtents(hasher, fileName)
+    else:
+        update_hash(hasher, fileName)
+    hashValue = hasher.hexdigest()
+    if cache is not None:
+        cache.put(fileName, key, digestType, hashValue)
+    return hashValue
 
-print 'Found %d sets of potential dupes...' % potentialCount
-print 'Scanning for real dupes...'
+class ConfirmStatistics:
+    """Time taken and bytes read by one way of confirming duplicates."""
 
-dupes = []
-for aSet in potentialDupes:
-    outFiles = []
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.bytesRead = 0
+        self.seconds = 0.0
+        self._started = None
+
+    def start(self):
+        self._started = time.time()
+
+    def stop(self, files, bytesRead):
+        self.seconds += time.time() - self._started
+        self.files += files
+        self.bytesRead += bytesRead
+
+    def __str__(self):
+        return '%s %d files: read %d bytes in %.2f seconds' % (
+            self.name, self.files, self.bytesRead, self.seconds)
+
+class _Groups(list):
+    """List of groups of identical files with the number of bytes read
+    to find them."""
+    bytesRead = 0
+
+def compareFiles(fileNames):
+    """Compare files of the same size by reading them in lockstep.
+
+    Files are split into groups whenever a block differs, and a file is
+    no longer read once it matches no other file, so reading stops at
+    the first difference. Returns a list of groups of two or more
+    identical files, in the order given, with the total number of bytes
+    read as its bytesRead attribute."""
+    result = _Groups()
+    files = [(fileName, io.open(fileName, "rb")) for fileName in fileNames]
+    try:
+        for fileName, f in files:
+            fadvise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
+        groups = [files]
+        while groups:
+            remaining = []
+            for group in groups:
+                blocks = {}
+                order = []
+                for fileName, f in group:
+                    block = f.read(COMPARE_BLOCK_SIZE)
+                    result.bytesRead += len(block)
+                    if not blocks.has_key(block):
+                        blocks[block] = []
+                        order.append(block)
+                    blocks[block].append((fileName, f))
+                for block in order:
+                    if len(blocks[block]) < 2:
+                        continue
+                    if not block:
+                        # All at end of file together, so identical
+                        result.append([fileName
+                                       for fileName, f in blocks[block]])
+                    else:
+                        remaining.append(blocks[block])
+            groups = remaining
+    finally:
+        for fileName, f in files:
+            if not dedup_common.KEEP_PAGE_CACHE:
+                fadvise(f.fileno(), "POSIX_FADV_DONTNEED")
+            f.close()
+    return result
+
+def hashFiles(fileKeys, size, cache, extents=None):
+    """Hash files of the same size to find which are identical.
+
+    fileKeys is a list of (fileName, key). If extents is given, every
+    file has those data extents and only they are hashed. Returns a
+    list of groups of two or more identical files, in the order given,
+    with the total number of bytes read as its bytesRead attribute."""
+    result = _Groups()
+    if extents is None:
+        bytesPerFile = size
+    else:
+        bytesPerFile = sum([length for offset, length in extents])
     hashes = {}
-    for fileName in aSet:
+    order = []
+    for fileName, key in fileKeys:
         print 'Scanning file "%s"...' % fileName
-        aFile = file(fileName, 'r')
-        hasher = md5.new()
-        while True:
-            r = aFile.read(4096)
-            if not len(r):
-                break
-            hasher.update(r)
-        aFile.close()
-        hashValue = hasher.digest()
-        if hashes.has_key(hashValue):
-            if not len(outFiles):
-                outFiles.append(hashes[hashValue])
-            outFiles.append(fileName)
-        else:
-            hashes[hashValue] = fileName
-    if len(outFiles):
-        dupes.append(outFiles)
-
-i = 0
-for d in dupes:
-    print 'Original is %s' % d[0]
-    for f in d[1:]:
-        i = i + 1
-        print 'Deleting %s' % f
-        os.remove(f)
-    print
+        if cache is not None:
+            misses = cache.misses
+        hashValue = hashFile(fileName, key, cache,
+                             extents=extents is not None)
+        if cache is None or cache.misses > misses:
+            result.bytesRead += bytesPerFile
+        if not hashes.has_key(hashValue):
+            hashes[hashValue] = []
+            order.append(hashValue)
+        hashes[hashValue].append(fileName)
+    for hashValue in order:
+        if len(hashes[hashValue]) > 1:
+            result.append(hashes[hashValue])
+    return result
+
+def useComparison(mode, files, size, cache):
+    """Should a set of files be confirmed by compareFiles() rather than
+    by hashing?
+
+    In "auto" mode comparison is used for small sets of files large
+    enough to be worth stopping early, unless there is a cache, as
+    digests can be reused by later runs and comparisons cannot."""
+    if mode == "auto":
+        return (files <= COMPARE_MAX_FILES and size >= COMPARE_MIN_SIZE
+                and cache is None)
+    return mode == "always"
+
+def _reclaimable(fileName):
+    """Return the bytes freed by replacing fileName, which is only
+    non-zero if this is the last link to the file, and only counts the
+    space allocated to a sparse file."""
+    st = os.lstat(fileName)
+    if st.st_nlink > 1:
+        return 0
+    blocks = getattr(st, "st_blocks", None)
+    if blocks is not None:
+        return min(st.st_size, blocks * 512)
+    return st.st_size
+
+def _tempName(fileName):
+    """Return an unused name in the same directory as fileName."""
+    dirName, baseName = os.path.split(fileName)
+    while True:
+        name = os.path.join(dirName, ".%s.dupinator-%d-%d" % (
+                baseName, os.getpid(), random.randint(0, sys.maxint)))
+        if not os.path.lexists(name):
+            return name
+
+def deleteDuplicate(original, duplicate):
+    """Delete duplicate, returning bytes reclaimed."""
+    reclaimed = _reclaimable(duplicate)
+    print 'Deleting %s' % duplicate
+    os.remove(duplicate)
+    return reclaimed
+
+def hardlinkDuplicate(original, duplicate):
+    """Replace duplicate with a hard link to original, returning bytes
+    reclaimed.
+
+    The link is made under a temporary name and renamed over the
+    duplicate, so the duplicate's path always exists."""
+    if os.path.samefile(original, duplicate):
+        return 0
+    reclaimed = _reclaimable(duplicate)
+    print 'Linking %s' % duplicate
+    temp = _tempName(duplicate)
+    os.link(original, temp)
+    try:
+        os.rename(temp, duplicate)
+    except:
+        os.remove(temp)
+        raise
+    return reclaimed
+
+def _xattrError(fileName):
+    e = ctypes.get_errno()
+    return OSError(e, os.strerror(e), fileName)
+
+def copyXattrs(source, destination):
+    """Copy the extended attributes of source, which include its ACLs,
+    to destination. Does nothing where source's filesystem has none.
+
+    Uses os.listxattr() and friends where they exist and Linux's libc
+    otherwise."""
+    global _libcXattr
+    if hasattr(os, "listxattr"):
+        for name in os.listxattr(source):
+            os.setxattr(destination, name, os.getxattr(source, name))
+        return
+    if _libcXattr is None:
+        _libcXattr = ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True)
+        for function in [_libcXattr.listxattr, _libcXattr.getxattr]:
+            function.restype = ctypes.c_ssize_t
+    size = _libcXattr.listxattr(source, None, 0)
+    if size < 0:
+        if ctypes.get_errno() == errno.ENOTSUP:
+            return
+        raise _xattrError(source)
+    names = ctypes.create_string_buffer(size)
+    size = _libcXattr.listxattr(source, names, size)
+    if size < 0:
+        raise _xattrError(source)
+    # Names each end with a NUL
+    for name in names.raw[:size].split("\0")[:-1]:
+        size = _libcXattr.getxattr(source, name, None, 0)
+        if size < 0:
+            raise _xattrError(source)
+        value = ctypes.create_string_buffer(size)
+        size = _libcXattr.getxattr(source, name, value, size)
+        if size < 0:
+            raise _xattrError(source)
+        if _libcXattr.setxattr(destination, name, value,
+                               ctypes.c_size_t(size), 0) != 0:
+            raise _xattrError(destination)
+
+_libcXattr = None
+
+def reflinkDuplicate(original, duplicate):
+    """Replace duplicate with a reflink (copy-on-write clone) of
+    original, returning bytes reclaimed.
+
+    Only works on Linux filesystems supporting FICLONE, e.g. btrfs and
+    XFS. The clone is made under a temporary name, given the
+    duplicate's owner, group, extended attributes, permissions and
+    times, and renamed over the duplicate. If any of them cannot be
+    kept the duplicate is left alone."""
+    if os.path.samefile(original, duplicate):
+        return 0
+    reclaimed = _reclaimable(duplicate)
+    print 'Reflinking %s' % duplicate
+    temp = _tempName(duplicate)
+    source = open(original, 'rb')
+    try:
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            try:
+                fcntl.ioctl(fd, FICLONE, source.fileno())
+            finally:
+                os.close(fd)
+            st = os.lstat(duplicate)
+            # Before the permissions, as chown() clears setuid bits
+            os.chown(temp, st.st_uid, st.st_gid)
+            copyXattrs(duplicate, temp)
+            shutil.copystat(duplicate, temp)
+            os.rename(temp, duplicate)
+        except:
+            os.remove(temp)
+            raise
+    finally:
+        source.close()
+    return reclaimed
+
+# Linux ioctl to clone a file, from linux/fs.h
+FICLONE = 0x40049409
+
+CONSOLIDATE = {
+    "delete" : deleteDuplicate,
+    "hardlink" : hardlinkDuplicate,
+    "reflink" : reflinkDuplicate,
+}
+
+def main(argv=None):
+    global DIGEST, PREFILTER_DIGEST
+    if argv is None:
+        argv = sys.argv
+    parser = OptionParser(
+        usage="%prog [<options>] <directory>...",
+        description=__doc__)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="walk directories with N parallel threads",
+                      metavar="N")
+    parser.add_option("-c", "--cache", dest="cache", default=None,
+                      help="cache digests between runs in FILE",
+                      metavar="FILE")
+    parser.add_option("-d", "--digest", dest="digest", default=DIGEST,
+                      type="choice", choices=sorted(DIGESTS.keys()),
+                      help="digest confirming duplicates: %s (default"
+                      " %%default)" % ", ".join(
+            [name for name in sorted(DIGESTS.keys()) if DIGESTS[name][1]]))
+    parser.add_option("--prefilter", dest="prefilter",
+                      default=PREFILTER_DIGEST,
+                      type="choice", choices=sorted(DIGESTS.keys()),
+                      help="digest of first 1024 bytes telling files apart:"
+                      " %s (default %%default)" %
+                      ", ".join(sorted(DIGESTS.keys())))
+    parser.add_option("--block-size", dest="blockSize", type="int",
+                      default=dedup_common.BLOCK_SIZE,
+                      help="read files BYTES at a time (default %default)",
+                      metavar="BYTES")
+    parser.add_option("--mmap-threshold", dest="mmapThreshold",
+                      type="int", default=dedup_common.MMAP_THRESHOLD,
+                      help="map files of at least BYTES into memory instead"
+                      " of reading them (default %default)",
+                      metavar="BYTES")
+    parser.add_option("--keep-page-cache", action="store_true",
+                      dest="keepPageCache", default=False,
+                      help="don't drop scanned files from the page cache")
+    parser.add_option("-m", "--mode", dest="mode", default="delete",
+                      type="choice", choices=sorted(CONSOLIDATE.keys()),
+                      help="delete duplicates, or replace them with a"
+                      " hardlink or reflink to the original"
+                      " (default %default)")
+    parser.add_option("--compare", dest="compare", default="auto",
+                      type="choice", choices=["auto", "always", "never"],
+                      help="confirm duplicates by comparing files byte by"
+                      " byte instead of hashing them: auto (for small"
+                      " sets of large files), always or never"
+                      " (default %default)")
+    parser.add_option("--min-size", dest="minSize", type="int",
+                      default=MIN_SIZE,
+                      help="skip files smaller than BYTES (default %default)",
+                      metavar="BYTES")
+    parser.add_option("--max-size", dest="maxSize", type="int",
+                      default=None,
+                      help="skip files larger than BYTES", metavar="BYTES")
+    parser.add_option("-x", "--exclude", dest="excludes", action="append",
+                      default=None,
+                      help="skip files and folders whose name, or path if"
+                      " PATTERN has a slash, matches the glob PATTERN; may"
+                      " be repeated (default %s)" % " ".join(DEFAULT_EXCLUDES),
+                      metavar="PATTERN")
+    parser.add_option("--ignore-file", dest="ignoreFiles", action="append",
+                      default=[],
+                      help="read .gitignore-style rules from files called"
+                      " NAME in each folder, e.g. .gitignore; may be"
+                      " repeated", metavar="NAME")
+    (options, args) = parser.parse_args(argv[1:])
+    if options.jobs < 1:
+        parser.error("Number of jobs must be at least 1")
+    if options.maxSize is not None and options.maxSize < options.minSize:
+        parser.error("Maximum size is less than minimum size")
+    if options.excludes is None:
+        options.excludes = DEFAULT_EXCLUDES
+    if options.blockSize < 1:
+        parser.error("Block size must be at least 1")
+    if not DIGESTS[options.digest][1]:
+        parser.error("%s is too weak to confirm duplicates" % options.digest)
+    DIGEST = options.digest
+    PREFILTER_DIGEST = options.prefilter
+    dedup_common.BLOCK_SIZE = options.blockSize
+    dedup_common.MMAP_THRESHOLD = options.mmapThreshold
+    dedup_common.KEEP_PAGE_CACHE = options.keepPageCache
+
+    cache = None
+    if options.cache:
+        cache = HashCache(os.path.expanduser(options.cache))
+
+    walkFilter = WalkFilter(options.minSize, options.maxSize,
+                            options.excludes, options.ignoreFiles)
+    for x in args:
+        print 'Scanning directory "%s"....' % x
+        for fileName, key in walkFiles(x, walkFilter, options.jobs):
+            filesBySize.setdefault(key[2], []).append((fileName, key))
+
+    print 'Finding potential dupes...'
+    potentialDupes = []
+    potentialCount = 0
+    linkGroups = []
+    # All the links to the inode of each file hashed which has others,
+    # as they are consolidated together
+    linksByFile = {}
+    trueType = type(True)
+    sizes = filesBySize.keys()
+    sizes.sort()
+    for k in sizes:
+        inFiles = filesBySize[k]
+        outFiles = []
+        hashes = {}
+        if len(inFiles) is 1: continue
+        inFiles.sort(key=_walkOrder)
+        # Only hash the first link found to each inode
+        links = {}
+        representatives = []
+        for fileName, key in inFiles:
+            inode = key[0:2]
+            if links.has_key(inode):
+                links[inode].append(fileName)
+                continue
+            links[inode] = [fileName]
+            representatives.append((fileName, key))
+        for l in links.values():
+            if len(l) > 1:
+                linkGroups.append(l)
+                linksByFile[l[0]] = l
+        inFiles = representatives
+        if len(inFiles) is 1: continue
+        print 'Testing %d files of size %d...' % (len(inFiles), k)
+        for fileName, key in inFiles:
+            if not os.path.isfile(fileName):
+                continue
+            hashValue = hashFile(fileName, key, cache, headOnly=True)
+            if hashes.has_key(hashValue):
+                x = hashes[hashValue]
+                if type(x) is not trueType:
+                    outFiles.append(hashes[hashValue])
+                    hashes[hashValue] = True
+                outFiles.append((fileName, key))
+            else:
+                hashes[hashValue] = (fileName, key)
+        if len(outFiles):
+            potentialDupes.append(outFiles)
+            potentialCount = potentialCount + len(outFiles)
+    filesBySize.clear()
+
+    print 'Found %d sets of potential dupes...' % potentialCount
+    print 'Scanning for real dupes with %s...' % DIGEST
+
+    dupes = []
+    compareStats = ConfirmStatistics("Compared")
+    hashStats = ConfirmStatistics("Hashed")
+    sparseStats = ConfirmStatistics("Hashed extents of sparse")
+    for aSet in potentialDupes:
+        size = aSet[0][1][2]
+        if len([f for f in aSet if isSparse(f[0])]) == len(aSet):
+            # Holes read as zeros, so only compare the data around them,
+            # and only of files with the same holes
+            sparseStats.start()
+            byExtents = {}
+            order = []
+            for fileName, key in aSet:
+                extents = extentMap(fileName)
+                if not byExtents.has_key(extents):
+                    byExtents[extents] = []
+                    order.append(extents)
+                byExtents[extents].append((fileName, key))
+            bytesRead = 0
+            for extents in order:
+                if len(byExtents[extents]) < 2:
+                    continue
+                groups = hashFiles(byExtents[extents], size, cache, extents)
+                bytesRead += groups.bytesRead
+                dupes.extend(groups)
+            sparseStats.stop(len(aSet), bytesRead)
+            continue
+        if useComparison(options.compare, len(aSet), size, cache):
+            for fileName, key in aSet:
+                print 'Comparing file "%s"...' % fileName
+            compareStats.start()
+            groups = compareFiles([fileName for fileName, key in aSet])
+            compareStats.stop(len(aSet), groups.bytesRead)
+            dupes.extend(groups)
+            continue
+        # A set may hold several groups of files with the same head
+        # but different contents, so keep each full hash separate.
+        hashStats.start()
+        groups = hashFiles(aSet, size, cache)
+        hashStats.stop(len(aSet), groups.bytesRead)
+        dupes.extend(groups)
+    for confirmStats in [compareStats, hashStats, sparseStats]:
+        print confirmStats
+
+    consolidate = CONSOLIDATE[options.mode]
+    i = 0
+    reclaimed = 0
+    for d in dupes:
+        print 'Original is %s' % d[0]
+        for duplicate in d[1:]:
+            # Every link to the duplicate, or its space is not freed
+            for f in linksByFile.get(duplicate, [duplicate]):
+                try:
+                    reclaimed += consolidate(d[0], f)
+                except (OSError, IOError), e:
+                    print 'Could not consolidate %s: %s' % (f, e)
+                    continue
+                i = i + 1
+        print
+    print '%d duplicates consolidated, %d bytes reclaimed' % (i, reclaimed)
+
+    linkGroups.sort()
+    for links in linkGroups:
+        print 'Already linked: %s' % ', '.join(links)
+    print 'Found %d sets of files already linked to each other' % \
+        len(linkGroups)
+
+    if cache is not None:
+        for x in args:
+            cache.evict(x)
+        cache.close()
+        print 'Cache %s: %d hits, %d misses, %d entries evicted' % (
+            cache.filename, cache.hits, cache.misses, cache.evicted)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
 ## end of http://code.activestate.com/recipes/362459/ }}}
@@ -1,70 +1,1233 @@
 #!/usr/bin/env python
 """Detect duplicate files
 
-%prog [<path>]
+%prog [<options>] [<path>]
+%prog --merge [<options>] <manifest>...
 
-Path is current directory if not given.
+Path is current directory if not given. Use --jobs to hash several
+files at once, which helps on fast disk arrays and network filesystems.
+
+Files are compared in stages so that as little data as possible is
+read: files are first grouped by size, files sharing a size are then
+compared by a hash of a sample from their head and tail, and only files
+which still collide are hashed in full. Hard links to the same file
+are read once and reported separately from duplicates. For very
+large trees use --spill-dir to keep the list of files on disk.
+Progress, rates and an estimate of the time left are shown on standard
+error, and can be kept in a file for monitoring with --metrics.
+
+With --cache and --incremental, a journal of the tree is kept with the
+cached digests, and later runs only list directories which have
+changed and only hash new or changed files.
+
+To find duplicates across machines, write a manifest of each tree with
+--manifest, which hashes every file and lists the digests sorted by
+size, then collect the manifests in one place and run with --merge.
+Only the manifests are moved, and they are merged in a single pass
+without being read into memory.
 """
-import hashlib
+import collections
+import csv
+import gzip
+import heapq
+import itertools
+import json
+import mmap
 from optparse import OptionParser
 import os.path
+import platform
+import Queue
+import re
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
+import time
+
+import dedup_common
+from dedup_common import (DIGESTS, HashCache, file_key, list_directory,
+                          new_digest, update_hash, walk_files)
+
+# Number of bytes hashed from each of the head and tail of a file in
+# the sample stage.
+SAMPLE_SIZE = 4096
+
+# Number of files recorded in memory before they are spilled to a run
+# file by size_groups_external().
+RUN_SIZE = 1000000
+
+# A group of duplicate files ("duplicates") or hard links to one file
+# ("links"). algorithm and digest are None for links, files is a list
+# of (filename, key) as returned by file_key().
+DuplicateGroup = collections.namedtuple("DuplicateGroup",
+                                        "kind size algorithm digest files")
+
+class ScanStatistics:
+    """Track how much data each stage of a scan read and avoided reading."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes_total = 0
+        # Bytes not read because a file was another link to an inode
+        self.links_skipped = 0
+        # Bytes not read because a file's size was unique
+        self.size_stage_avoided = 0
+        self.sample_stage_read = 0
+        # Bytes not read in full because the sample hash was unique
+        self.sample_stage_avoided = 0
+        self.full_stage_read = 0
+        # Bytes in files which share a size with another file and so
+        # must be hashed or otherwise settled, and bytes settled so far
+        self.candidate_bytes = 0
+        self.settled_bytes = 0
+        # Seconds spent in each stage. Walking is wall time, hashing is
+        # summed over all threads.
+        self.seconds = {}
+        self._lock = threading.Lock()
+
+    def timed(self, stage, function):
+        """Return function wrapped to add the time spent in it to the
+        seconds of stage."""
+        def wrapper(*args):
+            start = time.time()
+            try:
+                return function(*args)
+            finally:
+                elapsed = time.time() - start
+                with self._lock:
+                    self.seconds[stage] = self.seconds.get(stage, 0) + elapsed
+        return wrapper
+
+    def report(self):
+        """Return a human-readable report as a list of lines."""
+        return [
+            "Digests: %s prefilter, %s confirmation" % (PREFILTER_DIGEST,
+                                                        DIGEST),
+            "Scanned %d files, %d bytes" % (self.files, self.bytes_total),
+            "Hard links avoided reading %d bytes" % self.links_skipped,
+            "Size stage avoided reading %d bytes" % self.size_stage_avoided,
+            "Sample stage read %d bytes, avoided reading %d bytes" % (
+                self.sample_stage_read, self.sample_stage_avoided),
+            "Full hash stage read %d bytes" % self.full_stage_read,
+            "Stage times: %s" % (", ".join(
+                    ["%s %.1f s" % (stage, self.seconds[stage])
+                     for stage in ["walk", "sample", "full"]
+                     if stage in self.seconds]) or "none"),
+            ]
+
+# Digests used for the sample and full stages, may be changed by
+# options.
+DIGEST = dedup_common.DEFAULT_DIGEST
+PREFILTER_DIGEST = dedup_common.DEFAULT_PREFILTER_DIGEST
 
 def get_file_hash(filename):
-    """Return the hash of a filename as a string."""
-    BLOCK_SIZE = 1024  # Arbitrary
-    hash = hashlib.sha1()
+    """Return the DIGEST hash of a filename as a string."""
+    hash = new_digest(DIGEST)
+    update_hash(hash, filename)
+    return hash.hexdigest()
+
+def get_sample_hash(filename, size):
+    """Return the PREFILTER_DIGEST hash of the head and tail of a file
+    as a string.
+
+    If the file is no larger than the two samples, the whole file is
+    hashed and, if PREFILTER_DIGEST is strong, the result is as
+    definitive as get_file_hash()."""
+    hash = new_digest(PREFILTER_DIGEST)
     with open(filename) as f:
-        while True:
-                data = f.read(BLOCK_SIZE)
-                if not data:
-                    break
-                hash.update(data)
+        if size <= 2 * SAMPLE_SIZE:
+            hash.update(f.read())
+        else:
+            hash.update(f.read(SAMPLE_SIZE))
+            f.seek(-SAMPLE_SIZE, os.SEEK_END)
+            hash.update(f.read(SAMPLE_SIZE))
     return hash.hexdigest()
 
-def progress():
-    """Show progress"""
-    sys.stdout.write(".")
-    sys.stdout.flush()
+def sample_bytes(size):
+    """Return the number of bytes get_sample_hash() reads for a file."""
+    return min(size, 2 * SAMPLE_SIZE)
+
+def _mtime_ns(st):
+    """Return modification time from st in nanoseconds."""
+    return file_key(st)[3]
+
+class ScanJournal:
+    """Record of the directories and files seen by a walk, kept in the
+    database of a HashCache, so that the next walk only needs to list
+    directories whose modification time has changed.
+
+    A directory's modification time only changes when entries are
+    added, removed or renamed, so a file changed in place in an
+    unchanged directory is not noticed. Such files are caught if they
+    share a size with another file, see refresh(), otherwise not until
+    the directory changes."""
+
+    # Directories modified this recently are listed again next time, as
+    # a change in the same clock tick would not change their mtime.
+    RACY_SECONDS = 2
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._db = cache._db
+        self._db.execute("""CREATE TABLE IF NOT EXISTS directories (
+                              path BLOB PRIMARY KEY, parent BLOB,
+                              mtime_ns INTEGER)""")
+        self._db.execute("""CREATE INDEX IF NOT EXISTS directories_parent
+                            ON directories (parent)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS files (
+                              path BLOB PRIMARY KEY, directory BLOB,
+                              dev INTEGER, ino INTEGER,
+                              size INTEGER, mtime_ns INTEGER)""")
+        self._db.execute("""CREATE INDEX IF NOT EXISTS files_directory
+                            ON files (directory)""")
+        self.listed = 0
+        self.reused = 0
+        self.changed = 0
+
+    def walk(self, path):
+        """Yield (filename, key) for every regular file under path, like
+        walk_files(), but with absolute filenames."""
+        directories = [(os.path.abspath(path), None)]
+        while directories:
+            directory, parent = directories.pop()
+            try:
+                st = os.lstat(directory)
+            except OSError:
+                self._forget_directory(directory)
+                continue
+            mtime_ns = _mtime_ns(st)
+            row = self._db.execute(
+                "SELECT mtime_ns FROM directories WHERE path=?",
+                (sqlite3.Binary(directory),)).fetchone()
+            if row is not None and row[0] == mtime_ns:
+                self.reused += 1
+                subdirectories, files = self._listing(directory)
+            else:
+                try:
+                    subdirectories, files = list_directory(directory)
+                except OSError:
+                    self._forget_directory(directory)
+                    continue
+                self.listed += 1
+                if time.time() - st.st_mtime < self.RACY_SECONDS:
+                    mtime_ns = -1
+                self._record(directory, parent, mtime_ns,
+                             subdirectories, files)
+            for file in files:
+                yield file
+            directories.extend([(subdirectory, directory) for subdirectory
+                                in reversed(subdirectories)])
+
+    def _listing(self, directory):
+        """Return recorded subdirectories and files of directory."""
+        directory = sqlite3.Binary(directory)
+        subdirectories = [str(row[0]) for row in self._db.execute(
+                "SELECT path FROM directories WHERE parent=? ORDER BY path",
+                (directory,))]
+        files = [(str(path), (dev, ino, size, mtime_ns))
+                 for path, dev, ino, size, mtime_ns in self._db.execute(
+                """SELECT path, dev, ino, size, mtime_ns FROM files
+                   WHERE directory=?""", (directory,))]
+        return subdirectories, files
+
+    def _record(self, directory, parent, mtime_ns, subdirectories, files):
+        """Replace the record of directory with a new listing."""
+        old_subdirectories, old_files = self._listing(directory)
+        for subdirectory in set(old_subdirectories) - set(subdirectories):
+            self._forget_directory(subdirectory)
+        inodes = set([key[0:2] for filename, key in files])
+        for filename, key in old_files:
+            if key[0:2] not in inodes:
+                self._cache.forget(*key[0:2])
+        self._db.execute("DELETE FROM files WHERE directory=?",
+                         (sqlite3.Binary(directory),))
+        self._db.executemany(
+            """INSERT OR REPLACE INTO files
+               (path, directory, dev, ino, size, mtime_ns)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            [(sqlite3.Binary(filename), sqlite3.Binary(directory))
+             + tuple(key) for filename, key in files])
+        self._db.execute(
+            """INSERT OR REPLACE INTO directories (path, parent, mtime_ns)
+               VALUES (?, ?, ?)""",
+            (sqlite3.Binary(directory),
+             parent and sqlite3.Binary(parent), mtime_ns))
+
+    def _forget_directory(self, directory):
+        """Remove directory and everything under it from the journal and
+        the cache."""
+        prefix = sqlite3.Binary(os.path.join(directory, ""))
+        for dev, ino in self._db.execute(
+            """SELECT dev, ino FROM files
+               WHERE directory=? OR substr(directory, 1, ?)=?""",
+            (sqlite3.Binary(directory), len(prefix), prefix)).fetchall():
+            self._cache.forget(dev, ino)
+        self._db.execute(
+            "DELETE FROM files WHERE directory=? OR substr(directory, 1, ?)=?",
+            (sqlite3.Binary(directory), len(prefix), prefix))
+        self._db.execute(
+            "DELETE FROM directories WHERE path=? OR substr(path, 1, ?)=?",
+            (sqlite3.Binary(directory), len(prefix), prefix))
+
+    def refresh(self, size_groups):
+        """Check the files in each group of size_groups that could be a
+        duplicate against the filesystem, yielding the groups with
+        current keys.
+
+        A file which has changed is marked so its directory is listed
+        again next time, and is left out of the group if its size has
+        changed."""
+        for size, files in size_groups:
+            if len(files) > 1:
+                current = []
+                for filename, key in files:
+                    try:
+                        new_key = file_key(os.lstat(filename))
+                    except OSError:
+                        new_key = None
+                    if new_key != key:
+                        self.changed += 1
+                        self._db.execute(
+                            "UPDATE directories SET mtime_ns=-1 WHERE path=?",
+                            (sqlite3.Binary(os.path.dirname(filename)),))
+                        if new_key is None or new_key[2] != size:
+                            continue
+                    current.append((filename, new_key))
+                files = current
+            yield size, files
+
+    def report(self):
+        """Return a human-readable report as a list of lines."""
+        return [
+            "Journal: listed %d directories, reused %d,"
+            " %d files changed in place" % (
+                self.listed, self.reused, self.changed),
+            ]
+
+def group_by(items, key):
+    """Group items by key(item), returning only groups with more than
+    one member as a list of lists in order of first appearance."""
+    groups = {}
+    order = []
+    for item in items:
+        k = key(item)
+        if k not in groups:
+            groups[k] = []
+            order.append(k)
+        groups[k].append(item)
+    return [groups[k] for k in order if len(groups[k]) > 1]
+
+class PathTable:
+    """Append-only table of paths in a temporary file.
+
+    Each path is identified by an integer id. Directory names are
+    stored once and shared by the files in them, and the table is
+    mapped into memory for lookups, so it takes little memory
+    regardless of how many paths it holds."""
+
+    # Entry header: offset of parent directory entry or -1 for a
+    # directory, and length of the name following it
+    _header = struct.Struct("<qI")
+
+    def __init__(self, directory=None):
+        self._file = tempfile.TemporaryFile(dir=directory,
+                                            prefix="duplicate-files-paths")
+        self._offset = 0
+        self._last_directory = None
+        self._last_directory_id = None
+        self._map = None
+
+    def _append(self, parent, name):
+        id = self._offset
+        self._file.write(self._header.pack(parent, len(name)))
+        self._file.write(name)
+        self._offset += self._header.size + len(name)
+        return id
+
+    def add(self, path):
+        """Add path to table and return its id."""
+        directory, name = os.path.split(path)
+        # Files are added directory by directory as they are walked, so
+        # remembering the last directory is enough to intern them.
+        if directory != self._last_directory:
+            self._last_directory = directory
+            self._last_directory_id = self._append(-1, directory)
+        return self._append(self._last_directory_id, name)
+
+    def _entry(self, id):
+        parent, length = self._header.unpack_from(self._map, id)
+        start = id + self._header.size
+        return parent, self._map[start:start + length]
+
+    def get(self, id):
+        """Return the path with the given id."""
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        parent, name = self._entry(id)
+        return os.path.join(self._entry(parent)[1], name)
+
+    def close(self):
+        """Close and remove the table."""
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+# Record of a file in a run file: size, dev, inode, mtime_ns, path id
+_RUN_RECORD = struct.Struct("<QQQqQ")
+
+def write_run(records, directory=None):
+    """Sort records and write them to a temporary run file, which is
+    returned."""
+    records.sort()
+    run = tempfile.TemporaryFile(dir=directory,
+                                 prefix="duplicate-files-run")
+    for record in records:
+        run.write(_RUN_RECORD.pack(*record))
+    run.seek(0)
+    return run
+
+def read_run(run):
+    """Yield the records in a run file from its start."""
+    RECORDS_PER_READ = 4096
+    run.seek(0)
+    while True:
+        data = run.read(_RUN_RECORD.size * RECORDS_PER_READ)
+        if not data:
+            break
+        for offset in xrange(0, len(data), _RUN_RECORD.size):
+            yield _RUN_RECORD.unpack_from(data, offset)
+
+def _ticker(progress):
+    """Return the tick() method of a ProgressReporter, or a function
+    doing nothing if progress is None."""
+    if progress is None:
+        return lambda new_file=True: None
+    return progress.tick
+
+def size_groups_in_memory(files, stats, progress=None):
+    """Yield (size, [(filename, key), ...]) for the (filename, key)
+    pairs from files, e.g. from walk_files(), in order of size."""
+    tick = _ticker(progress)
+    start = time.time()
+    files_by_size = {}
+    for filename, key in files:
+        stats.files += 1
+        stats.bytes_total += key[2]
+        files_by_size.setdefault(key[2], []).append((filename, key))
+        tick()
+    for size, group in files_by_size.iteritems():
+        if len(group) > 1:
+            stats.candidate_bytes += size * len(group)
+    stats.seconds["walk"] = time.time() - start
+    for size in sorted(files_by_size.keys()):
+        yield size, files_by_size.pop(size)
+
+def size_groups_external(files, stats, directory=None, progress=None):
+    """Yield (size, [(filename, key), ...]) for the (filename, key)
+    pairs from files in order of size, like size_groups_in_memory().
+
+    Files are recorded in sorted runs of RUN_SIZE records which are
+    spilled to temporary files in directory and merged, so memory use
+    does not grow with the size of the tree. The runs are merged twice,
+    first only to count the bytes to be hashed."""
+    tick = _ticker(progress)
+    start = time.time()
+    paths = PathTable(directory)
+    runs = []
+    records = []
+    try:
+        for filename, key in files:
+            stats.files += 1
+            stats.bytes_total += key[2]
+            dev, ino, size, mtime_ns = key
+            records.append((size, dev, ino, mtime_ns, paths.add(filename)))
+            if len(records) >= RUN_SIZE:
+                runs.append(write_run(records, directory))
+                records = []
+            tick()
+        records.sort()
+        merged = heapq.merge(records, *[read_run(run) for run in runs])
+        for size, group in itertools.groupby(merged, lambda r: r[0]):
+            count = sum(1 for record in group)
+            if count > 1:
+                stats.candidate_bytes += size * count
+        stats.seconds["walk"] = time.time() - start
+        merged = heapq.merge(records, *[read_run(run) for run in runs])
+        for size, group in itertools.groupby(merged, lambda r: r[0]):
+            yield size, [(paths.get(path_id), (dev, ino, size, mtime_ns))
+                         for size, dev, ino, mtime_ns, path_id in group]
+    finally:
+        for run in runs:
+            run.close()
+        paths.close()
+
+class _Task:
+    """A unit of work handed to a worker thread by imap_bounded()."""
+
+    def __init__(self, function, item):
+        self.function = function
+        self.item = item
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.function(self.item)
+        except:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def get(self):
+        """Wait for the task and return its result, re-raising any
+        exception it raised."""
+        self.done.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+def _worker(queue):
+    """Run tasks from queue until given None."""
+    while True:
+        task = queue.get()
+        if task is None:
+            break
+        task.run()
+
+def imap_bounded(function, items, jobs=1):
+    """Yield function(item) for each item, in order, using jobs threads.
+
+    At most a few tasks per thread are outstanding at any time so
+    memory use does not grow with the number of items."""
+    if jobs < 2:
+        for item in items:
+            yield function(item)
+        return
+    queue = Queue.Queue(maxsize=jobs * 2)
+    threads = []
+    for i in range(jobs):
+        thread = threading.Thread(target=_worker, args=(queue,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    pending = collections.deque()
+    try:
+        for item in items:
+            task = _Task(function, item)
+            queue.put(task)
+            pending.append(task)
+            while pending and (pending[0].done.is_set() or
+                               len(pending) > jobs * 4):
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+def hash_candidates(candidates, hash_function, digest_type, cache=None,
+                    jobs=1):
+    """Yield (candidate, digest, cached) for each candidate in order.
+
+    Candidates are (size, filename, key) tuples. Digests found in cache
+    are not recomputed, the rest are computed with hash_function(filename,
+    size) and added to cache. A candidate of None is a marker and is
+    passed through as (None, None, True)."""
+    def lookup():
+        for candidate in candidates:
+            digest = None
+            if cache is not None and candidate is not None:
+                digest = cache.get(candidate[2], digest_type)
+            yield candidate, digest
+    def compute(item):
+        candidate, digest = item
+        if candidate is None or digest is not None:
+            return candidate, digest, True
+        size, filename, key = candidate
+        return candidate, hash_function(filename, size), False
+    for candidate, digest, cached in imap_bounded(compute, lookup(), jobs):
+        if cache is not None and not cached:
+            cache.put(candidate[1], candidate[2], digest_type, digest)
+        yield candidate, digest, cached
+
+def _result_size(result):
+    """Return the size of the candidate of a hash_candidates() result,
+    or None for a marker."""
+    return result[0] and result[0][0]
+
+def find_duplicates(size_groups, stats, jobs=1, cache=None, progress=None):
+    """Yield a DuplicateGroup for each set of duplicate files or of hard
+    links to the same file in size_groups.
 
-def progress_complete():
-    """Complete output of progress"""
-    sys.stdout.write("\n")
-    sys.stdout.flush()
+    size_groups yields (size, [(filename, key), ...]) in order of size,
+    e.g. from size_groups_in_memory(). Each inode is only read once and
+    is represented in duplicates by the first of its links. Groups are
+    yielded as soon as they are confirmed. progress, if given, is a
+    ProgressReporter told of each file hashed."""
+    tick = _ticker(progress)
+    # Groups confirmed before the full hash stage. Each stage passes on
+    # a None marker after adding to found so they are yielded promptly.
+    found = collections.deque()
+
+    def sample_candidates():
+        for size, files in size_groups:
+            if len(files) < 2:
+                stats.size_stage_avoided += size
+                continue
+            # Sorting by key brings links to the same inode together
+            files.sort(key=lambda file: (file[1], file[0]))
+            representatives = []
+            for inode, links in itertools.groupby(
+                files, lambda file: file[1][0:2]):
+                links = list(links)
+                if len(links) > 1:
+                    stats.links_skipped += size * (len(links) - 1)
+                    stats.settled_bytes += size * (len(links) - 1)
+                    found.append(DuplicateGroup("links", size, None, None,
+                                                links))
+                representatives.append(links[0])
+            if len(representatives) < len(files):
+                yield None
+            if len(representatives) < 2:
+                stats.size_stage_avoided += size
+                stats.settled_bytes += size
+                continue
+            for filename, key in representatives:
+                yield size, filename, key
+
+    def full_candidates():
+        samples = hash_candidates(
+            sample_candidates(), stats.timed("sample", get_sample_hash),
+            "%s-sample-%d" % (PREFILTER_DIGEST, SAMPLE_SIZE), cache, jobs)
+        for size, results in itertools.groupby(samples, _result_size):
+            if size is None:
+                yield None
+                continue
+            results = list(results)
+            for candidate, sample_hash, cached in results:
+                if not cached:
+                    stats.sample_stage_read += sample_bytes(size)
+                tick()
+            groups = group_by(results, lambda result: result[1])
+            survivors = sum([len(group) for group in groups])
+            # Everything not read by the sample stage would have been
+            # read by the full stage, except for files which survive
+            # the sample stage.
+            stats.sample_stage_avoided += (size - sample_bytes(size)) * \
+                (len(results) - survivors)
+            if size <= 2 * SAMPLE_SIZE and DIGESTS[PREFILTER_DIGEST][1]:
+                # Sample covered the whole file, so its hash is that of
+                # the whole file
+                stats.settled_bytes += size * len(results)
+                for group in groups:
+                    found.append(DuplicateGroup(
+                            "duplicates", size, PREFILTER_DIGEST, group[0][1],
+                            [candidate[1:] for candidate, h, c in group]))
+                if groups:
+                    yield None
+                continue
+            stats.settled_bytes += size * (len(results) - survivors)
+            for group in groups:
+                for candidate, sample_hash, cached in group:
+                    yield candidate
+
+    def full(filename, size):
+        return get_file_hash(filename)
+    hashes = hash_candidates(full_candidates(), stats.timed("full", full),
+                             DIGEST, cache, jobs)
+    for size, results in itertools.groupby(hashes, _result_size):
+        while found:
+            yield found.popleft()
+        if size is None:
+            continue
+        results = list(results)
+        for candidate, file_hash, cached in results:
+            if not cached:
+                stats.full_stage_read += size
+            stats.settled_bytes += size
+            # Already counted by the sample stage
+            tick(False)
+        for group in group_by(results, lambda result: result[1]):
+            yield DuplicateGroup("duplicates", size, DIGEST, group[0][1],
+                                 [candidate[1:] for candidate, h, c in group])
+    while found:
+        yield found.popleft()
+
+# First line of a manifest written by write_manifest()
+MANIFEST_MAGIC = "# duplicate-files manifest 1"
+
+_ESCAPES = {"\\" : "\\\\", "\t" : "\\t", "\n" : "\\n", "\r" : "\\r"}
+_UNESCAPES = dict([(escaped[1], c) for c, escaped in _ESCAPES.items()])
+
+def _escape(text):
+    """Escape characters which would break up a line of a manifest."""
+    return re.sub(r"[\\\t\n\r]", lambda m: _ESCAPES[m.group()], text)
+
+def _unescape(text):
+    """Reverse _escape()."""
+    return re.sub(r"\\(.)", lambda m: _UNESCAPES[m.group(1)], text)
+
+def manifest_entries(size_groups, stats, jobs=1, cache=None, progress=None):
+    """Yield (size, digest, filename) for every file in size_groups, in
+    order of size and then DIGEST digest.
+
+    Unlike find_duplicates(), every file is hashed in full, as a file
+    with a unique size here may have a copy elsewhere. Each inode is
+    only read once."""
+    tick = _ticker(progress)
+    # Links to each inode being hashed, a list per size group
+    pending = collections.deque()
+
+    def candidates():
+        for size, files in size_groups:
+            # The walk is over, and every file is to be hashed
+            stats.candidate_bytes = stats.bytes_total
+            if not files:
+                continue
+            files.sort(key=lambda file: (file[1], file[0]))
+            inodes = [list(links) for inode, links in itertools.groupby(
+                    files, lambda file: file[1][0:2])]
+            for links in inodes:
+                stats.links_skipped += size * (len(links) - 1)
+                stats.settled_bytes += size * (len(links) - 1)
+            pending.append(inodes)
+            for links in inodes:
+                yield size, links[0][0], links[0][1]
+
+    def full(filename, size):
+        return get_file_hash(filename)
+    hashes = hash_candidates(candidates(), stats.timed("full", full),
+                             DIGEST, cache, jobs)
+    for size, results in itertools.groupby(hashes, _result_size):
+        entries = []
+        for (candidate, digest, cached), links in zip(results,
+                                                      pending.popleft()):
+            if not cached:
+                stats.full_stage_read += size
+            stats.settled_bytes += size
+            tick()
+            entries.extend([(size, digest, filename)
+                            for filename, key in links])
+        entries.sort()
+        for entry in entries:
+            yield entry
+
+def write_manifest(entries, filename, host, root):
+    """Write a manifest of entries from manifest_entries() to filename,
+    or to standard output if filename is "-".
+
+    The manifest is written compressed if filename ends in .gz, and is
+    only put in place once complete."""
+    if filename == "-":
+        output = sys.stdout
+    else:
+        temporary = filename + ".tmp"
+        if filename.endswith(".gz"):
+            output = gzip.open(temporary, "wb")
+        else:
+            output = open(temporary, "wb")
+    output.write(MANIFEST_MAGIC + "\n")
+    output.write("# host %s\n" % _escape(host))
+    output.write("# algorithm %s\n" % DIGEST)
+    output.write("# root %s\n" % _escape(root))
+    for size, digest, path in entries:
+        output.write("%d\t%s\t%s\n" % (size, digest, _escape(path)))
+    if filename == "-":
+        output.flush()
+    else:
+        output.close()
+        os.rename(temporary, filename)
+
+class ManifestReader:
+    """Read a manifest written by write_manifest().
+
+    The header is read when the manifest is opened. Iterating over the
+    reader then yields (size, digest, host, path) for each file, in
+    order, reading the manifest a line at a time."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        if filename.endswith(".gz"):
+            self._file = gzip.open(filename, "rb")
+        else:
+            self._file = open(filename, "rb")
+        if self._file.readline().rstrip("\n") != MANIFEST_MAGIC:
+            raise ValueError("%s is not a duplicate-files manifest" %
+                             filename)
+        header = {}
+        self._line = self._file.readline()
+        while self._line.startswith("# "):
+            name, value = self._line[2:].rstrip("\n").split(" ", 1)
+            header[name] = _unescape(value)
+            self._line = self._file.readline()
+        self.host = header.get("host")
+        self.algorithm = header.get("algorithm")
+        self.root = header.get("root")
+
+    def __iter__(self):
+        previous = None
+        line = self._line
+        try:
+            while line:
+                size, digest, path = line.rstrip("\n").split("\t")
+                size = long(size)
+                if previous is not None and (size, digest) < previous:
+                    raise ValueError("%s is not sorted at %s" %
+                                     (self.filename, path))
+                previous = (size, digest)
+                yield size, digest, self.host, _unescape(path)
+                line = self._file.readline()
+        finally:
+            self._file.close()
+
+class MergeStatistics:
+    """Track what merging manifests found."""
+
+    def __init__(self, manifests):
+        self.manifests = manifests
+        self.files = 0
+        self.groups = 0
+        # Bytes which could be freed by keeping one copy of each group
+        self.duplicated = 0
+
+    def report(self):
+        """Return a human-readable report as a list of lines."""
+        return [
+            "Merged %d manifests of %d files" % (self.manifests, self.files),
+            "Found %d groups duplicated across hosts, %d duplicated bytes" % (
+                self.groups, self.duplicated),
+            ]
+
+def merge_manifests(readers, stats):
+    """Yield a DuplicateGroup for each set of files with the same digest
+    found on more than one host in the ManifestReaders readers.
+
+    Each file is named host:path. The manifests are sorted, so they are
+    merged in one pass holding only a group at a time in memory."""
+    merged = heapq.merge(*readers)
+    for (size, digest), entries in itertools.groupby(
+        merged, lambda entry: entry[0:2]):
+        entries = list(entries)
+        stats.files += len(entries)
+        if len(set([host for s, d, host, path in entries])) < 2:
+            continue
+        stats.groups += 1
+        stats.duplicated += size * (len(entries) - 1)
+        yield DuplicateGroup(
+            "duplicates", size, readers[0].algorithm, digest,
+            [("%s:%s" % (host, path), (None, None, size, None))
+             for s, d, host, path in entries])
+
+class TextReport:
+    """Report duplicates as text once the scan is complete.
+
+    Groups are sorted by size so the report does not depend on the
+    order in which they were found."""
+
+    def __init__(self, output):
+        self.output = output
+        self.duplicates = []
+        self.link_groups = []
+
+    def add(self, group):
+        """Add a DuplicateGroup to the report."""
+        filenames = [filename for filename, key in group.files]
+        if group.kind == "links":
+            self.link_groups.append((group.size, filenames))
+        else:
+            self.duplicates.append((group.size, filenames))
+
+    def finish(self):
+        """Write the report."""
+        for title, groups in [("Duplicates:", self.duplicates),
+                              ("Hard links:", self.link_groups)]:
+            for size, filenames in sorted(groups):
+                self.output.write(title + "\n")
+                for filename in filenames:
+                    self.output.write("\t" + filename + "\n")
+        self.output.flush()
+
+class JSONLinesReport:
+    """Report each group as a JSON object on its own line as soon as it
+    is found."""
+
+    def __init__(self, output):
+        self.output = output
+
+    @staticmethod
+    def _file(filename, key):
+        dev, ino, size, mtime_ns = key
+        record = {"dev" : dev, "inode" : ino, "mtime_ns" : mtime_ns}
+        try:
+            record["path"] = filename.decode(sys.getfilesystemencoding()
+                                             or "utf-8")
+        except UnicodeError:
+            # Not valid text, so give the exact bytes as well
+            record["path"] = filename.decode("utf-8", "replace")
+            record["path_hex"] = filename.encode("hex")
+        return record
+
+    def add(self, group):
+        """Write a DuplicateGroup."""
+        record = {
+            "kind" : group.kind,
+            "size" : group.size,
+            "algorithm" : group.algorithm,
+            "digest" : group.digest,
+            "files" : [self._file(filename, key)
+                       for filename, key in group.files],
+            }
+        self.output.write(json.dumps(record, sort_keys=True) + "\n")
+        self.output.flush()
+
+    def finish(self):
+        pass
+
+class CSVReport:
+    """Report each group as CSV rows, one per file, as soon as it is
+    found. Files in the same group share a group number."""
+
+    def __init__(self, output):
+        self.output = output
+        self.writer = csv.writer(output)
+        self.writer.writerow(["group", "kind", "size", "algorithm",
+                              "digest", "path", "dev", "inode", "mtime_ns"])
+        self.groups = 0
+
+    def add(self, group):
+        """Write a DuplicateGroup."""
+        self.groups += 1
+        for filename, (dev, ino, size, mtime_ns) in group.files:
+            self.writer.writerow([self.groups, group.kind, group.size,
+                                  group.algorithm or "", group.digest or "",
+                                  filename,
+                                  dev, ino, mtime_ns])
+        self.output.flush()
+
+    def finish(self):
+        pass
+
+REPORTS = {
+    "text" : TextReport,
+    "jsonl" : JSONLinesReport,
+    "csv" : CSVReport,
+}
+
+class ProgressReporter:
+    """Report the progress of a scan in a status line.
+
+    The line shows the stage, the rate at which files are walked or
+    hashed and bytes read, the bytes of candidate files still to be
+    settled and an estimate of the time left. It is written at most
+    once every interval seconds, over the previous line if output is a
+    terminal. If metrics is a filename, the same figures are written to
+    it in the Prometheus text format each time, for monitoring."""
+
+    def __init__(self, stats, output=sys.stderr, interval=1.0, metrics=None):
+        self.stats = stats
+        self.output = output
+        self.interval = interval
+        self.metrics = metrics
+        # Files hashed or found in the cache, once however many stages
+        # read them
+        self.hashed = 0
+        self._start = time.time()
+        self._next = self._start + interval
+        self._width = 0
+
+    def tick(self, new_file=True):
+        """Note a file walked or hashed, updating the status if it is
+        due. new_file is False for a file already counted by an earlier
+        stage, such as one hashed in full after its sample."""
+        if new_file and "walk" in self.stats.seconds:
+            self.hashed += 1
+        now = time.time()
+        if now >= self._next:
+            self._next = now + self.interval
+            self.update(now)
+
+    def figures(self, now=None):
+        """Return a dictionary of the current figures."""
+        stats = self.stats
+        if now is None:
+            now = time.time()
+        figures = {
+            "files" : stats.files,
+            "hashed" : self.hashed,
+            "bytes_read" : stats.sample_stage_read + stats.full_stage_read,
+            "remaining" : max(stats.candidate_bytes - stats.settled_bytes, 0),
+            "eta" : None,
+            }
+        walk = stats.seconds.get("walk")
+        if walk is None:
+            figures["stage"] = "walk"
+            elapsed = max(now - self._start, 0.001)
+            figures["files_rate"] = stats.files / elapsed
+            figures["bytes_rate"] = 0.0
+            return figures
+        figures["stage"] = "hash"
+        elapsed = max(now - self._start - walk, 0.001)
+        figures["files_rate"] = self.hashed / elapsed
+        figures["bytes_rate"] = figures["bytes_read"] / elapsed
+        # Files dropped by the sample stage or found in the cache are
+        # settled without being read in full, so estimate from the rate
+        # of settling rather than of reading.
+        settled_rate = stats.settled_bytes / elapsed
+        if settled_rate > 0:
+            figures["eta"] = figures["remaining"] / settled_rate
+        return figures
+
+    def update(self, now=None):
+        """Write the status line and metrics."""
+        figures = self.figures(now)
+        if figures["stage"] == "walk":
+            line = "Walking: %d files, %.1f files/s" % (
+                figures["files"], figures["files_rate"])
+        else:
+            line = ("Hashing: %d of %d files, %.1f files/s, %.1f MB/s,"
+                    " %.1f MB remaining, ETA %s" % (
+                    figures["hashed"], figures["files"],
+                    figures["files_rate"], figures["bytes_rate"] / 1e6,
+                    figures["remaining"] / 1e6,
+                    _format_duration(figures["eta"])))
+        if self.output is not None:
+            if self.output.isatty():
+                self.output.write("\r" + line.ljust(self._width))
+                self._width = len(line)
+            else:
+                self.output.write(line + "\n")
+            self.output.flush()
+        if self.metrics:
+            self._write_metrics(figures, False)
+
+    def finish(self):
+        """Clear the status line and write the final metrics."""
+        if self.output is not None and self._width:
+            self.output.write("\r" + " " * self._width + "\r")
+            self.output.flush()
+        if self.metrics:
+            self._write_metrics(self.figures(), True)
+
+    def _write_metrics(self, figures, finished):
+        stats = self.stats
+        lines = [
+            "duplicate_files_start_time_seconds %f" % self._start,
+            "duplicate_files_finished %d" % finished,
+            "duplicate_files_files_scanned %d" % figures["files"],
+            "duplicate_files_files_hashed %d" % figures["hashed"],
+            "duplicate_files_bytes_scanned %d" % stats.bytes_total,
+            'duplicate_files_bytes_read{stage="sample"} %d' %
+            stats.sample_stage_read,
+            'duplicate_files_bytes_read{stage="full"} %d' %
+            stats.full_stage_read,
+            "duplicate_files_bytes_remaining %d" % figures["remaining"],
+            "duplicate_files_files_per_second %f" % figures["files_rate"],
+            "duplicate_files_bytes_per_second %f" % figures["bytes_rate"],
+            ]
+        for stage, seconds in sorted(stats.seconds.items()):
+            lines.append('duplicate_files_stage_seconds{stage="%s"} %f' % (
+                    stage, seconds))
+        if figures["eta"] is not None:
+            lines.append("duplicate_files_eta_seconds %f" % figures["eta"])
+        # Replace the file whole so it is never read half written
+        temporary = self.metrics + ".tmp"
+        with open(temporary, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(temporary, self.metrics)
+
+def _format_duration(seconds):
+    """Return seconds as H:MM:SS, or "unknown" for None."""
+    if seconds is None:
+        return "unknown"
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
 
 def main(argv=None):
+    global DIGEST, PREFILTER_DIGEST
     if argv is None:
         argv = sys.argv
     parser = OptionParser(
         usage=__doc__, # printed with -h/--help
         version="%prog 1.0" # automatically generates --version
         )
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="walk and hash with N parallel threads",
+                      metavar="N")
+    parser.add_option("-c", "--cache", dest="cache", default=None,
+                      help="cache digests between runs in FILE",
+                      metavar="FILE")
+    parser.add_option("-i", "--incremental", action="store_true",
+                      dest="incremental", default=False,
+                      help="keep a journal of the tree in the cache and"
+                      " only list directories changed since the last run")
+    parser.add_option("--block-size", dest="block_size", type="int",
+                      default=dedup_common.BLOCK_SIZE,
+                      help="read files BYTES at a time (default %default)",
+                      metavar="BYTES")
+    parser.add_option("--mmap-threshold", dest="mmap_threshold",
+                      type="int", default=dedup_common.MMAP_THRESHOLD,
+                      help="map files of at least BYTES into memory instead"
+                      " of reading them (default %default)",
+                      metavar="BYTES")
+    parser.add_option("--keep-page-cache", action="store_true",
+                      dest="keep_page_cache", default=False,
+                      help="don't drop scanned files from the page cache")
+    parser.add_option("--spill-dir", dest="spill_dir", default=None,
+                      help="keep the list of files in sorted runs in"
+                      " temporary files in DIR instead of in memory",
+                      metavar="DIR")
+    parser.add_option("-d", "--digest", dest="digest", default=DIGEST,
+                      type="choice", choices=sorted(DIGESTS.keys()),
+                      help="digest confirming duplicates: %s (default"
+                      " %%default)" % ", ".join(
+            [name for name in sorted(DIGESTS.keys()) if DIGESTS[name][1]]))
+    parser.add_option("--prefilter", dest="prefilter",
+                      default=PREFILTER_DIGEST,
+                      type="choice", choices=sorted(DIGESTS.keys()),
+                      help="digest of samples telling files apart: %s"
+                      " (default %%default)" %
+                      ", ".join(sorted(DIGESTS.keys())))
+    parser.add_option("-f", "--format", dest="format", default="text",
+                      type="choice", choices=sorted(REPORTS.keys()),
+                      help="report duplicates as text, or as jsonl or csv"
+                      " as soon as they are found (default %default)")
+    parser.add_option("--progress-interval", dest="progress_interval",
+                      type="float", default=None,
+                      help="update progress every SECONDS (default 1 on a"
+                      " terminal, 60 otherwise)", metavar="SECONDS")
+    parser.add_option("--metrics", dest="metrics", default=None,
+                      help="keep FILE updated with progress metrics in"
+                      " Prometheus text format", metavar="FILE")
+    parser.add_option("-m", "--manifest", dest="manifest", default=None,
+                      help="write the digests of all files to FILE, which"
+                      " is compressed if it ends in .gz, or - for standard"
+                      " output, instead of reporting duplicates",
+                      metavar="FILE")
+    parser.add_option("--host", dest="host", default=platform.node(),
+                      help="name of this host in the manifest"
+                      " (default %default)", metavar="NAME")
+    parser.add_option("--merge", action="store_true", dest="merge",
+                      default=False,
+                      help="report files duplicated across the hosts of the"
+                      " manifests given as arguments")
     (options, args) = parser.parse_args()
+    if options.merge:
+        if options.manifest:
+            parser.error("--merge and --manifest are exclusive")
+        if not args:
+            parser.error("Manifests required with --merge")
+        try:
+            readers = [ManifestReader(filename) for filename in args]
+        except (IOError, ValueError), e:
+            parser.error(str(e))
+        if len(set([reader.algorithm for reader in readers])) > 1:
+            parser.error("Manifests use different digests: %s" % ", ".join(
+                    ["%s (%s)" % (reader.filename, reader.algorithm)
+                     for reader in readers]))
+        stats = MergeStatistics(len(readers))
+        report = REPORTS[options.format](sys.stdout)
+        for group in merge_manifests(readers, stats):
+            report.add(group)
+        report.finish()
+        if options.format == "text":
+            summary = sys.stdout
+        else:
+            summary = sys.stderr
+        for line in stats.report():
+            summary.write(line + "\n")
+        return 0
     if len(args) > 0:
         path = args.pop()
         if not os.path.exists(path):
             parser.error("Path \"%s\" does not exist" % path)
     else:
         path = "."
+    if options.jobs < 1:
+        parser.error("Number of jobs must be at least 1")
+    if options.block_size < 1:
+        parser.error("Block size must be at least 1")
+    if options.progress_interval is None:
+        options.progress_interval = 1.0 if sys.stderr.isatty() else 60.0
+    if options.incremental and not options.cache:
+        parser.error("--incremental needs --cache")
+    if options.incremental and options.manifest:
+        # The journal only notices files changed in place if they could
+        # be duplicates, but every file goes in a manifest
+        parser.error("--incremental cannot be used with --manifest")
+    if not DIGESTS[options.digest][1]:
+        parser.error("%s is too weak to confirm duplicates" % options.digest)
+    if options.spill_dir and not os.path.isdir(options.spill_dir):
+        parser.error("Spill directory \"%s\" does not exist" %
+                     options.spill_dir)
+    dedup_common.BLOCK_SIZE = options.block_size
+    dedup_common.MMAP_THRESHOLD = options.mmap_threshold
+    dedup_common.KEEP_PAGE_CACHE = options.keep_page_cache
+    DIGEST = options.digest
+    PREFILTER_DIGEST = options.prefilter
 
-    file_hashes = {}
-    for directory_name, subdirectory_names, filenames in os.walk(path):
-        for filename in [os.path.join(directory_name, filename)\
-                             for filename in filenames]:
-            file_hash = get_file_hash(filename)
-            if file_hash in file_hashes:
-                file_hashes[file_hash].append(filename)
-            else:
-                file_hashes[file_hash] = [filename]
-            print ".",
-            sys.stdout.flush()
-    print
-
-    for file_hash, filenames in file_hashes.items():
-        if len(filenames) > 1:
-            print "Duplicates:"
-            for filename in filenames:
-                print "\t" + filename
+    if options.manifest:
+        # Paths in a manifest must make sense away from this directory
+        path = os.path.abspath(path)
+
+    cache = None
+    if options.cache:
+        cache = HashCache(os.path.expanduser(options.cache))
+    stats = ScanStatistics()
+    progress = ProgressReporter(stats, interval=options.progress_interval,
+                                metrics=options.metrics)
+    journal = None
+    if options.incremental:
+        journal = ScanJournal(cache)
+        files = journal.walk(path)
+    else:
+        files = walk_files(path, options.jobs)
+    if options.spill_dir:
+        size_groups = size_groups_external(files, stats, options.spill_dir,
+                                           progress)
+    else:
+        size_groups = size_groups_in_memory(files, stats, progress)
+    if journal is not None:
+        size_groups = journal.refresh(size_groups)
+    if options.manifest:
+        report = None
+        write_manifest(manifest_entries(size_groups, stats,
+                                        jobs=options.jobs, cache=cache,
+                                        progress=progress),
+                       options.manifest, options.host, path)
+    else:
+        report = REPORTS[options.format](sys.stdout)
+        for group in find_duplicates(size_groups, stats,
+                                     jobs=options.jobs, cache=cache,
+                                     progress=progress):
+            report.add(group)
+    progress.finish()
+    if cache is not None:
+        if journal is None:
+            # The journal evicts entries as it finds files removed
+            cache.evict(path)
+        cache.close()
+    if report is not None:
+        report.finish()
+
+    # Keep statistics out of machine-readable output
+    if options.format == "text" and not options.manifest:
+        summary = sys.stdout
+    else:
+        summary = sys.stderr
+    for line in stats.report():
+        summary.write(line + "\n")
+    if journal is not None:
+        for line in journal.report():
+            summary.write(line + "\n")
+    if cache is not None:
+        for line in cache.report():
+            summary.write(line + "\n")
     return 0
 
 if __name__ == "__main__":
@@ -0,0 +1,124 @@
+"""Compression of backup tarballs, shared by backup-web-server.py and
+vm-backup.py
+
+This is a module, not a script: install.sh installs it next to the
+scripts, keeping its .py extension, so they can import it.
+"""
+import collections
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+import os
+import struct
+import subprocess
+import threading
+import time
+import zlib
+
+# Blocks compressed at once by ParallelGzip
+BLOCK_SIZE = 1024 * 1024
+
+class ParallelGzip:
+    """Compress a file object to gzip format in a thread of this
+    process, for when pigz is not installed. Looks enough like the
+    subprocess.Popen of a compressor to be used in its place.
+
+    The input is cut into blocks compressed at once by a pool of
+    threads, zlib letting go of the interpreter lock while it works,
+    and written in order as raw deflate streams ending with a sync
+    flush, which join into one. Each block starts with no history, so
+    the output is a little larger than gzip's."""
+
+    def __init__(self, stdin, output, jobs, level=6):
+        # Input from a file object, or a pipe written to by others
+        self.stdin = None
+        if stdin == subprocess.PIPE:
+            readFD, writeFD = os.pipe()
+            stdin = os.fdopen(readFD, "rb")
+            self.stdin = os.fdopen(writeFD, "wb")
+        self._source = stdin
+        self._jobs = jobs
+        self._level = level
+        # Output to a pipe, or a file object which is left open
+        self.stdout = None
+        if output == subprocess.PIPE:
+            readFD, writeFD = os.pipe()
+            self.stdout = os.fdopen(readFD, "rb")
+            output = os.fdopen(writeFD, "wb")
+        self._output = output
+        self.returncode = None
+        self._killed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def _compress(self, block, last=False):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(
+            last and zlib.Z_FINISH or zlib.Z_SYNC_FLUSH)
+
+    def _run(self):
+        pool = ThreadPool(self._jobs)
+        pending = collections.deque()
+        crc = 0
+        size = 0
+        try:
+            # Header: magic, deflate, no flags, time, no extra flags,
+            # unknown OS
+            self._output.write(struct.pack("<BBBBLBB", 0x1f, 0x8b, 8, 0,
+                                           long(time.time()), 0, 255))
+            while not self._killed:
+                block = self._source.read(BLOCK_SIZE)
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                pending.append(pool.apply_async(self._compress, (block,)))
+                # Keep every thread busy without holding the whole input
+                while len(pending) > self._jobs * 2:
+                    self._output.write(pending.popleft().get())
+            while pending:
+                self._output.write(pending.popleft().get())
+            self._output.write(self._compress("", last=True))
+            self._output.write(struct.pack("<LL", crc & 0xffffffffL,
+                                           size & 0xffffffffL))
+            self._output.flush()
+            self.returncode = self._killed and 1 or 0
+        except (IOError, OSError), e:
+            # Whatever reads the output has probably gone
+            if not self._killed:
+                print "Compression failed: %s" % e
+            self.returncode = 1
+        finally:
+            pool.terminate()
+            self._source.close()
+            if self.stdout is not None:
+                self._output.close()
+
+    def poll(self):
+        if self._thread.is_alive():
+            return None
+        return self.returncode
+
+    def wait(self):
+        self._thread.join()
+        return self.returncode
+
+    def kill(self):
+        self._killed = True
+        if self.stdout is not None:
+            # Wake the thread if it is stuck writing to the pipe
+            self.stdout.close()
+
+def compressCmd(compressor, jobs, pigz="pigz", zstd="zstd"):
+    """Return the file name suffix and command to compress with
+    compressor using jobs threads, pigz and zstd being the commands to
+    run for gzip and zstd. The command is None to compress with
+    ParallelGzip, as when pigz or zstd is not installed, and empty not
+    to compress."""
+    if compressor == "none":
+        return "", []
+    if compressor == "zstd" and find_executable(zstd):
+        return ".zst", [zstd, "-q", "-c", "-T%d" % jobs]
+    if compressor == "gzip" and find_executable(pigz):
+        return ".gz", [pigz, "-c", "-p", str(jobs)]
+    return ".gz", None
@@ -7,6 +7,10 @@ authentication.
 Uses vmware-cmd:
 http://www.vmware.com/support/esx21/doc/vmware-cmd.html
 
+Tarballs are compressed with --compressor: gzip (pigz if installed,
+else with zlib in this process), zlib (in this process with a pool of
+threads), zstd (zlib if not installed) or none.
+
 $Id$
 
 TODO:
@@ -20,13 +24,16 @@ from __future__ import with_statement
 binaries = {
     "scp" : "scp",
     "md5sum" : "md5sum",
-    "ls" : "ls"
+    "ls" : "ls",
+    "pigz" : "pigz",
+    "zstd" : "zstd",
 }
 
 ######################################################################
 
 import atexit
 import fnmatch
+import multiprocessing
 import optparse
 import os
 import os.path
@@ -36,6 +43,12 @@ import sys
 import tempfile
 import time
 
+# parallel_gzip.py is in utils/ in the source tree and installed next
+# to this script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "utils"))
+from parallel_gzip import ParallelGzip, compressCmd
+
 
 ######################################################################
 
@@ -144,8 +157,9 @@ class VirtualMachine(VirtualMachineBaseObject):
         return max(map(os.path.getmtime, fileList))
     
         
-    def backup(self, tarfile):
-        """Back up VM to given tarball file."""
+    def backup(self, tarfile, compressor="gzip", jobs=1):
+        """Back up VM to given tarball file, compressed with compressor
+        using jobs threads."""
         restartVM = False
         state = self.getState()
         self.debug("VM state is %s" % state)
@@ -170,15 +184,30 @@ class VirtualMachine(VirtualMachineBaseObject):
         try:
             # Try to keep output from tar in sync with rest of output
             sys.stdout.flush()
-            status = subprocess.call(
-                ["tar", "cfvzP", tarfile] + files,
-                # We're going to create tarfile from parent of the VM
-                cwd = parent,
-                # Try to keep stderr and stdout in sync
-                stderr=subprocess.STDOUT)
+            command = compressCmd(compressor, jobs, binaries["pigz"],
+                                  binaries["zstd"])[1]
+            with open(tarfile, "wb") as output:
+                # With the archive on stdout, tar lists files on stderr
+                tar = subprocess.Popen(
+                    ["tar", "cfvP", "-"] + files,
+                    # We're going to create tarfile from parent of the VM
+                    cwd = parent,
+                    stdout=command == [] and output or subprocess.PIPE)
+                processes = [("tar", tar)]
+                if command is None:
+                    processes.append(
+                        ("zlib", ParallelGzip(tar.stdout, output, jobs)))
+                elif command:
+                    processes.append((command[0], subprocess.Popen(
+                                command, stdin=tar.stdout, stdout=output)))
+                    tar.stdout.close()
+                statuses = [(name, process.wait())
+                            for name, process in processes]
             sys.stdout.flush()
-            if status != 0:
-                raise VirtualMachineException("tar returned %d" % status)
+            for name, status in statuses:
+                if status != 0:
+                    raise VirtualMachineException("%s returned %d" %
+                                                  (name, status))
         finally:
             if restartVM:
                 self.debug("Restarting VM.")
@@ -230,6 +259,14 @@ def main(argv=None):
                       help="Turn on debug messages")
     parser.add_option("-s", "--scpDest", dest="scpDest", default=None,
                       help="save backups to SCPTARGET. This be a scp-style destination (e.g. user@host:/some/path)", metavar="SCPTARGET")
+    parser.add_option("-C", "--compressor", dest="compressor",
+                      default="gzip", type="choice",
+                      choices=["gzip", "zlib", "zstd", "none"],
+                      help="compress with gzip, zlib, zstd or none (default %default)")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="compress with N threads (default %default)",
+                      metavar="N")
     (options, args) = parser.parse_args(argv)
 
     if not (options.destDir or options.scpDest):
@@ -247,6 +284,12 @@ def main(argv=None):
         atexit.register(os.rmdir, workingDir)
         print "Temporary directory is %s" % workingDir
 
+    suffix, command = compressCmd(options.compressor, options.jobs,
+                                   binaries["pigz"], binaries["zstd"])
+    if command is None and options.compressor != "zlib":
+        print "%s is not installed, compressing with zlib in process." % (
+            binaries[options.compressor == "gzip" and "pigz" or "zstd"])
+
     vmServer = VirtualMachineServer()
     if options.debug:
         vmServer.setDebug()
@@ -261,7 +304,7 @@ def main(argv=None):
     for vm in vms:
         print "Examining \"%s\"" % vm.name()
         markTime()
-        tarfile = os.path.join(workingDir, vm.name() + ".tar.gz")
+        tarfile = os.path.join(workingDir, vm.name() + ".tar" + suffix)
         vmModTime = vm.getModTime()
         print "VM modification time: %s" % time.ctime(vmModTime)
         lastBackup = vm.getLastBackupTime()
@@ -274,7 +317,7 @@ def main(argv=None):
                 continue
         try:
             print "Backing up VM to %s" % tarfile
-            vm.backup(tarfile)
+            vm.backup(tarfile, options.compressor, options.jobs)
         except Exception, e:
             print "Error backing up VM:\n" + str(e)
             if os.path.exists(tarfile):